@@ -1,50 +1,89 @@
+import asyncio
+from typing import Awaitable, Callable
+
 from models.exceptions import SourceTypeError
 from models.models import Paper, PaperExtractedData, PaperMetadata
 from service.arxiv_svc import fetch_paper_metadata, fetch_pdf_content
 from service.chunk_svc import chunk_and_embed_text
+from service.embed_svc import EMBED_MODEL_NAME
 from service.extract_svc import (
-    extract_paper_dataset,
-    extract_paper_methods,
-    extract_paper_models,
-    extract_paper_tasking,
+    EXTRACT_MODEL_NAME,
+    EXTRACTOR_VERSION,
+    extract_paper_all,
 )
+from utils.cache import content_hash, read_cache, write_cache
 from utils.constants import SourceType
+from utils.logger import log
+
+EXTRACTED_DATA_CACHE_NAMESPACE = "extracted_data"
 
 
 async def retrieve_paper_metadata(source: SourceType, paper_id: str) -> PaperMetadata:
-    match source:
-        case SourceType.ARXIV:
-            return await fetch_paper_metadata(paper_id)
-        case _:
-            raise SourceTypeError
-
-
-async def retrieve_paper_extracted_data(pdf_url: str) -> PaperExtractedData:
-    pdf_text = fetch_pdf_content(pdf_url)
-    datasets = await extract_paper_dataset(pdf_text)
-    models = await extract_paper_models(pdf_text)
-    methods = await extract_paper_methods(pdf_text)
-    tasking = await extract_paper_tasking(pdf_text)
-    content = await chunk_and_embed_text(pdf_text)
-
-    return PaperExtractedData(
-        content=content,
-        datasets=datasets,
-        models=models,
-        methods=methods,
-        tasking=tasking,
+    handler = _METADATA_HANDLERS.get(source)
+    if handler is None:
+        raise SourceTypeError
+    return await handler(paper_id)
+
+
+async def retrieve_paper_extracted_data(
+    pdf_url: str, use_cache: bool = True
+) -> PaperExtractedData:
+    pdf_text = await fetch_pdf_content(pdf_url)
+
+    # The entities depend on the extract model and the chunk vectors on the
+    # embed model, so a change of either must not reuse older entries
+    cache_key = "{}-v{}".format(
+        content_hash(f"{EXTRACT_MODEL_NAME}\0{EMBED_MODEL_NAME}\0{pdf_text}"),
+        EXTRACTOR_VERSION,
     )
+    if use_cache:
+        cached = await asyncio.to_thread(
+            read_cache, EXTRACTED_DATA_CACHE_NAMESPACE, cache_key
+        )
+        if cached is not None:
+            log.info(f"Extracted data cache hit: {cache_key}")
+            return PaperExtractedData.model_validate_json(cached)
+
+    # The extraction and the chunk embedding are independent calls, so start
+    # the embedding first and let it run while the extraction is in flight
+    content_task = asyncio.create_task(chunk_and_embed_text(pdf_text))
+    try:
+        entities = await extract_paper_all(pdf_text)
+    except BaseException:
+        content_task.cancel()
+        raise
+    content = await content_task
+
+    # Records come from our own extraction and embedding, so skip revalidation
+    extracted_data = PaperExtractedData.model_construct(content=content, **entities)
+    await asyncio.to_thread(
+        write_cache,
+        EXTRACTED_DATA_CACHE_NAMESPACE,
+        cache_key,
+        extracted_data.model_dump_json(),
+    )
+    return extracted_data
+
+
+async def retrieve_paper(
+    source: SourceType, paper_id: str, use_cache: bool = True
+) -> Paper:
+    handler = _PAPER_HANDLERS.get(source)
+    if handler is None:
+        raise SourceTypeError
+    return await handler(paper_id, use_cache)
 
 
-async def retrieve_paper(source: SourceType, paper_id: str) -> Paper:
-    match source:
-        case SourceType.ARXIV:
-            return await _retrieve_paper_arxiv(paper_id)
-        case _:
-            raise SourceTypeError
+async def _retrieve_paper_arxiv(paper_id: str, use_cache: bool) -> Paper:
+    metadata = await fetch_paper_metadata(paper_id, use_cache)
+    pdf_data = await retrieve_paper_extracted_data(metadata.pdf_url, use_cache)
+    return Paper.model_construct(metadata=metadata, pdf_data=pdf_data)
 
 
-async def _retrieve_paper_arxiv(paper_id: str) -> Paper:
-    metadata = await fetch_paper_metadata(paper_id)
-    pdf_data = await retrieve_paper_extracted_data(metadata.pdf_url)
-    return Paper(metadata=metadata, pdf_data=pdf_data)
+# Handlers for each supported source, register new sources here
+_METADATA_HANDLERS: dict[SourceType, Callable[[str], Awaitable[PaperMetadata]]] = {
+    SourceType.ARXIV: fetch_paper_metadata,
+}
+_PAPER_HANDLERS: dict[SourceType, Callable[[str, bool], Awaitable[Paper]]] = {
+    SourceType.ARXIV: _retrieve_paper_arxiv,
+}
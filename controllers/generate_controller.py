@@ -1,4 +1,7 @@
-import matplotlib.pyplot as plt
+import asyncio
+import weakref
+from collections.abc import AsyncIterator
+
 import networkx as nx
 
 from controllers.fetch_controller import (
@@ -10,22 +13,44 @@ from service.arxiv_svc import (
     fetch_document_id_by_topic,
 )
 from service.neo4j_svc import (
+    DATABASE_NAME,
     check_paper_exists,
     get_neo4j_driver,
-    store_authors,
-    store_content_chunks,
-    store_paper_node,
-    store_paper_similarity_links,
+    invalidate_graph_schema,
+    store_paper_records,
     store_semantic_entities,
 )
-from service.query_svc import GraphQueryResult, query
+from service.query_svc import (
+    GraphQueryResult,
+    batch_query,
+    clear_cache,
+    query,
+    query_stream,
+)
 from utils.constants import SourceType
 from utils.logger import log
 from utils.utils import get_envvar
 
+PAPER_CONCURRENCY = int(get_envvar("PAPER_CONCURRENCY", "8"))
+EXPORT_GRAPH_PNG = get_envvar("EXPORT_GRAPH_PNG", "0") == "1"
+
+# Held while a paper is checked and written, so concurrent imports of the same
+# paper cannot both pass the existence check. Unused locks are dropped
+_paper_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = (
+    weakref.WeakValueDictionary()
+)
+
+# (PaperExtractedData attribute, plot node type, relation to the paper)
+ENTITY_KINDS = (
+    ("datasets", "dataset", "dataset trained on"),
+    ("models", "model", "model used"),
+    ("methods", "method", "method used"),
+    ("tasking", "tasking", "tasking performed"),
+)
+
 
-def _retrieve_document_ids(topic: str, num_papers: int) -> list:
-    ids = fetch_document_id_by_topic(topic, num_papers)
+async def _retrieve_document_ids(topic: str, num_papers: int) -> list:
+    ids = await fetch_document_id_by_topic(topic, num_papers)
     for id in ids:
         id["source"] = SourceType.ARXIV
 
@@ -33,18 +58,35 @@ def _retrieve_document_ids(topic: str, num_papers: int) -> list:
 
 
 async def generate_ontology_graph(topic: str, num_papers: int):
-    data = {}
-    ids = _retrieve_document_ids(topic, num_papers)
+    ids = await _retrieve_document_ids(topic, num_papers)
     log.info(f"Processing ids: {[id['id'] for id in ids]}")
 
-    for id in ids:
-        log.info(f"Processing paper with id: {id['id']}")
-        data[id["id"]] = await retrieve_paper(id["source"], id["id"])
+    # Bound the number of papers in flight to stay within the API rate limits
+    sem = asyncio.Semaphore(PAPER_CONCURRENCY)
+
+    async def _retrieve_one(id: dict) -> tuple[str, Paper]:
+        async with sem:
+            log.info(f"Processing paper with id: {id['id']}")
+            return id["id"], await retrieve_paper(id["source"], id["id"])
+
+    results = await asyncio.gather(*[_retrieve_one(id) for id in ids])
+    data = dict(results)
 
     _plot_nodes(data)
 
 
 def _plot_nodes(data: dict):
+    # Layout and rasterisation are expensive, so only plot when asked to
+    if not EXPORT_GRAPH_PNG:
+        return
+
+    # Imported here so the API never pays for matplotlib unless plotting, and
+    # rendered off-screen since the plot is only ever written to a file
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
     color_map = {
         "paper": "lightgray",
         "author": "pink",
@@ -54,46 +96,42 @@ def _plot_nodes(data: dict):
         "tasking": "purple",
     }
 
-    graph = nx.Graph()
+    # Collect the nodes and edges first and add them to the graph in bulk.
+    # Later entries overwrite earlier ones, as repeated add_node calls would.
+    nodes: dict[str, str] = {}
+    edges: list[tuple[str, str, dict]] = []
 
     for document_id, document_data in data.items():
         # Add the document node
-        graph.add_node(document_id, type="paper")
+        nodes[document_id] = "paper"
 
         # Add the author nodes and link it to the current paper
         for author in document_data.metadata.authors:
-            graph.add_node(author, type="author")
-            graph.add_edge(document_id, author, relation="written by")
-
-        # Add the database nodes and link it to the current paper
-        for dataset in document_data.pdf_data.datasets:
-            ds_name = dataset.title.lower()
-            graph.add_node(ds_name, type="dataset")
-            graph.add_edge(document_id, ds_name, relation="dataset trained on")
-
-        # Add the model nodes and link it to the current paper
-        for model in document_data.pdf_data.models:
-            model_name = model.title.lower()
-            graph.add_node(model_name, type="model")
-            graph.add_edge(document_id, model_name, relation="model used")
-
-        # Add the model nodes and link it to the current paper
-        for method in document_data.pdf_data.methods:
-            method_name = method.title.lower()
-            graph.add_node(method_name, type="method")
-            graph.add_edge(document_id, method_name, relation="method used")
-
-        # Add the tasking nodes and link it to the current paper
-        for task in document_data.pdf_data.tasking:
-            task_name = task.title.lower()
-            graph.add_node(task_name, type="tasking")
-            graph.add_edge(document_id, task_name, relation="tasking performed")
+            nodes[author] = "author"
+            edges.append((document_id, author, {"relation": "written by"}))
+
+        # Add the dataset, model, method and tasking nodes and link them to
+        # the current paper
+        for attr, node_type, relation in ENTITY_KINDS:
+            for entity in getattr(document_data.pdf_data, attr):
+                name = entity.title.lower()
+                nodes[name] = node_type
+                edges.append((document_id, name, {"relation": relation}))
+
+    graph = nx.Graph()
+    graph.add_nodes_from(
+        (node, {"type": node_type}) for node, node_type in nodes.items()
+    )
+    graph.add_edges_from(edges)
 
     # Extract colors based on node attribute
-    node_colors = [color_map[graph.nodes[n].get("type", "paper")] for n in graph.nodes]
+    node_colors = [
+        color_map.get(node_type or "paper", "lightgray")
+        for _, node_type in graph.nodes(data="type")
+    ]
 
     plt.figure(figsize=(15, 15))  # Bigger canvas
-    pos = nx.spring_layout(graph, k=0.7, iterations=100)  # Spread nodes more
+    pos = _layout_nodes(graph)
     nx.draw(
         graph,
         pos,
@@ -102,31 +140,65 @@ def _plot_nodes(data: dict):
         node_size=1200,
         font_size=8,
     )
-    plt.savefig("graph.png")
+    plt.savefig("graph.png", dpi=100)
+
+
+def _layout_nodes(graph: nx.Graph) -> dict:
+    # sfdp is a multilevel layout implemented in C, far faster than the pure
+    # Python spring layout on large graphs, but needs the optional pygraphviz.
+    # Without the Graphviz binaries pygraphviz imports fine and fails on call
+    try:
+        return nx.nx_agraph.graphviz_layout(graph, prog="sfdp")
+    except (ImportError, OSError, ValueError):
+        pass
+
+    # Fewer iterations are needed to converge as the graph grows
+    iterations = min(100, max(20, 2000 // max(len(graph), 1)))
+    return nx.spring_layout(graph, k=0.7, iterations=iterations, seed=0)
 
 
-def add_to_graph(paper: Paper):
+async def add_to_graph(paper: Paper):
+    lock = _paper_locks.setdefault(paper.metadata.id, asyncio.Lock())
+    async with lock:
+        # The Neo4j driver is synchronous, so keep its writes off the event loop
+        await asyncio.to_thread(_add_to_graph, paper)
+    # Cached query and vector search results may miss the new paper, and
+    # the paper may have brought new labels or relationship types
+    clear_cache()
+    invalidate_graph_schema()
+
+
+def _add_to_graph(paper: Paper):
     if check_paper_exists(paper.metadata.id):
         raise PaperAlreadyExistsError(
             detail=f"Paper with {paper.metadata.id} already exist"
         )
     driver = get_neo4j_driver()
-    with driver.session(database=get_envvar("NEO4J_DATABASE_NAME")) as session:
+    with driver.session(database=DATABASE_NAME) as session:
         meta = paper.metadata
         pdf_data = paper.pdf_data
         id = meta.id
 
-        store_paper_node(session, meta)
-        store_authors(session, meta)
-        store_content_chunks(session, pdf_data, id)
+        # The semantic entities are written in their own transactions since
+        # their vector index deduplication only sees committed nodes
+        session.execute_write(store_paper_records, meta, pdf_data)
         store_semantic_entities(session, pdf_data, id)
-        store_paper_similarity_links(session, meta)
 
 
-def check_paper_exists_graph(paper_id: str) -> bool:
-    return check_paper_exists(paper_id)
+async def check_paper_exists_graph(paper_id: str) -> bool:
+    return await asyncio.to_thread(check_paper_exists, paper_id)
 
 
 async def query_database(query_text: str) -> GraphQueryResult:
     log.info("Processing Query")
     return await query(query_text)
+
+
+async def query_database_batch(query_texts: list[str]) -> list[GraphQueryResult]:
+    log.info("Processing Batch Query of %d questions", len(query_texts))
+    return await batch_query(query_texts)
+
+
+def query_database_stream(query_text: str) -> AsyncIterator[GraphQueryResult]:
+    log.info("Processing Streamed Query")
+    return query_stream(query_text)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from models.models import AblationConfig, QAResultModel, QueryAnswerPair
 from service.judge_svc import evaluate_response
 from service.query_svc import query
@@ -7,11 +9,14 @@ from utils.logger import log
 async def evaluate_qns_ans_with_judge(
     query_text: str,
     expected_ans: str,
-    ablation_config: dict = None
+    ablation_config: Optional[AblationConfig] = None
 ) -> QAResultModel:
 
-    config = AblationConfig(**ablation_config) if ablation_config else None
-    graph_response = await query(query_text, ablation_config=config)
+    # Evaluations must score a fresh answer to this exact question, never one
+    # reused from a similar question
+    graph_response = await query(
+        query_text, ablation_config=ablation_config, use_semantic_cache=False
+    )
 
     qapair = QueryAnswerPair(
         query=query_text,
@@ -22,4 +27,5 @@ async def evaluate_qns_ans_with_judge(
     log.debug(f"QA Pair: {qapair}")
 
     evaluation = await evaluate_response(qapair)
-    return QAResultModel(qapair=qapair, evaluation=evaluation)
+    # Both parts are already validated models, so skip revalidation
+    return QAResultModel.model_construct(qapair=qapair, evaluation=evaluation)
@@ -1,9 +1,41 @@
 from datetime import datetime
-from typing import Annotated, Optional, TypeAlias
+from functools import cached_property
+from typing import Annotated, Any, Optional, TypeAlias
 
-from pydantic import BaseModel, Field
+import numpy as np
+import orjson
+from pydantic import BaseModel, Field, PlainSerializer, PlainValidator, WithJsonSchema
 
-EmbeddingVector: TypeAlias = list[float]
+
+def _to_embedding_array(value: Any) -> np.ndarray:
+    # Pydantic only reports a ValueError as a validation error, so the
+    # TypeError NumPy raises for non-numeric input is converted
+    try:
+        embedding = np.asarray(value, dtype=np.float32)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Embedding must be a one-dimensional list of numbers") from e
+    if embedding.ndim != 1:
+        raise ValueError("Embedding must be a one-dimensional list of numbers")
+    # NumPy turns null into NaN, which the vector indexes cannot search with
+    if not np.isfinite(embedding).all():
+        raise ValueError("Embedding must only contain finite numbers")
+    return embedding
+
+
+def _to_embedding_list(embedding: np.ndarray) -> list[float]:
+    # tolist() widens each value to float64, whose repr carries about twice the
+    # digits. orjson writes the shortest digits that round-trip at float32
+    return orjson.loads(orjson.dumps(embedding, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+# Embeddings are held as float32 arrays, which take a fraction of the memory of
+# a list of Python floats, and are exchanged as plain lists of numbers in JSON
+EmbeddingVector: TypeAlias = Annotated[
+    np.ndarray,
+    PlainValidator(_to_embedding_array),
+    PlainSerializer(_to_embedding_list, return_type=list[float]),
+    WithJsonSchema({"type": "array", "items": {"type": "number"}}),
+]
 
 
 class PaperMetadata(BaseModel):
@@ -131,3 +163,8 @@ class AblationConfig(BaseModel):
     excluded_relationships: Optional[list[str]] = None
     # Override top_k for vector search
     max_vector_results: Optional[int] = 5
+
+    @cached_property
+    def excluded_node_types_set(self) -> frozenset[str]:
+        """Excluded node types as a set, for label lookups"""
+        return frozenset(self.excluded_node_types or ())
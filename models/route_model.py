@@ -28,6 +28,10 @@ class QueryModel(BaseModel):
     qns: str = Field(..., example="What is the ...")
 
 
+class BatchQueryModel(BaseModel):
+    qns: list[str] = Field(..., min_length=1, example=["What is the ..."])
+
+
 class EvidenceModel(BaseModel):
     id: Annotated[str, Field(min_length=1)]
     txt: Annotated[str, Field(min_length=1)]
@@ -1,4 +1,9 @@
-from fastapi import FastAPI, Response
+from contextlib import asynccontextmanager
+from typing import Annotated
+
+import orjson
+from fastapi import FastAPI, Header, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
 from controllers.fetch_controller import (
     retrieve_paper,
@@ -10,41 +15,71 @@ from controllers.generate_controller import (
     check_paper_exists_graph,
     generate_ontology_graph,
     query_database,
+    query_database_batch,
+    query_database_stream,
 )
 from controllers.judge_controller import evaluate_qns_ans_with_judge
 from models.exceptions import PaperAlreadyExistsError
 from models.models import Paper
 from models.route_model import (
+    BatchQueryModel,
     BuildGraphModel,
     EvaluationQueryModel,
     ExtractModel,
     GetPaperModel,
     QueryModel,
 )
+from service.arxiv_svc import close_http_client, shutdown_pdf_pool, start_pdf_pool
+from service.embed_svc import close_embedding_client
 from service.eval_svc import evaluate_query_relevance
+from service.neo4j_svc import close_neo4j_driver, ensure_lookup_indexes
 from utils.logger import log
 
-app = FastAPI()
+# The health check is hit often and never changes, so encode it only once
+HEALTH_CHECK_CONTENT = orjson.dumps({"message": "Working"})
+
+# Cache-Control directives that make an endpoint skip its cached results
+CACHE_BYPASS_DIRECTIVES = frozenset({"no-cache", "no-store"})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_lookup_indexes()
+    start_pdf_pool()
+    yield
+    await close_http_client()
+    await close_embedding_client()
+    shutdown_pdf_pool()
+    close_neo4j_driver()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 
 @app.get("/")
 async def main():
     log.info("Health Check")
-    return {"message": "Working"}
+    return Response(content=HEALTH_CHECK_CONTENT, media_type="application/json")
 
 
 @app.post("/getpapermetadata/")
 async def get_paper_metadata(req: GetPaperModel, res: Response):
     log.info("Processing Get Paper Metadata Request")
-    data = retrieve_paper_metadata(req.source, req.paper_id)
-    return data
+    data = await retrieve_paper_metadata(req.source, req.paper_id)
+    return ORJSONResponse(data.model_dump(mode="json"))
 
 
 @app.post("/extractpaperdata/")
-async def extract_paper_data(req: ExtractModel, res: Response):
+async def extract_paper_data(
+    req: ExtractModel,
+    res: Response,
+    cache_control: Annotated[str | None, Header()] = None,
+):
     log.info("Processing Extract Paper Data Request")
-    data = await retrieve_paper_extracted_data(req.paper_pdf_url)
-    return data
+    data = await retrieve_paper_extracted_data(
+        req.paper_pdf_url, _allows_cache(cache_control)
+    )
+    return ORJSONResponse(data.model_dump(mode="json"))
 
 
 @app.post("/buildgraph/")
@@ -58,32 +93,58 @@ async def buildgraph(req: BuildGraphModel, res: Response):
 async def extract_paper(req: GetPaperModel, res: Response):
     log.info("Processing Extract Paper Metadata and Data Request")
     data = await retrieve_paper(req.source, req.paper_id)
-    return data
+    return ORJSONResponse(data.model_dump(mode="json"))
 
 
 @app.post("/addtograph/")
 async def add_paper_to_graph(paper: Paper, res: Response):
-    log.info(f"Adding paper '{paper.metadata.title}' to Neo4j graph")
-    add_to_graph(paper)
-    return {"message": f"Paper '{paper.metadata.title}' successfully added to graph"}
+    log.info("Adding paper '%s' to Neo4j graph", paper.metadata.title)
+    await add_to_graph(paper)
+    message = f"Paper '{paper.metadata.title}' successfully added to graph"
+    return ORJSONResponse({"message": message})
 
 
 @app.post("/importpaper/")
-async def import_paper_to_graph(req: GetPaperModel, res: Response):
+async def import_paper_to_graph(
+    req: GetPaperModel,
+    res: Response,
+    cache_control: Annotated[str | None, Header()] = None,
+):
     log.info("Processing Extract Paper Metadata and Data Request")
-    if check_paper_exists_graph(req.paper_id):
+    if await check_paper_exists_graph(req.paper_id):
         raise PaperAlreadyExistsError(
             detail=f"Paper with {req.paper_id} already exist")
-    paper = await retrieve_paper(req.source, req.paper_id)
-    log.info(f"Adding paper '{paper.metadata.title}' to Neo4j graph")
-    add_to_graph(paper)
-    return {"message": f"Paper '{paper.metadata.title}' successfully added to graph"}
+    paper = await retrieve_paper(req.source, req.paper_id, _allows_cache(cache_control))
+    log.info("Adding paper '%s' to Neo4j graph", paper.metadata.title)
+    await add_to_graph(paper)
+    message = f"Paper '{paper.metadata.title}' successfully added to graph"
+    return ORJSONResponse({"message": message})
 
 
 @app.post("/query/")
 async def send_query_database(req: QueryModel, res: Response):
     log.info("Processing Query")
-    return await query_database(req.qns)
+    result = await query_database(req.qns)
+    return ORJSONResponse(result.model_dump(mode="json"))
+
+
+@app.post("/query/batch/")
+async def send_batch_query_database(req: BatchQueryModel, res: Response):
+    """Answer several questions concurrently, in the order they were given."""
+    log.info("Processing Batch Query")
+    results = await query_database_batch(req.qns)
+    return ORJSONResponse([result.model_dump(mode="json") for result in results])
+
+
+@app.post("/query/stream/")
+async def stream_query_database(req: QueryModel):
+    """Stream the answer as it is generated, one JSON result per line."""
+
+    async def _result_lines():
+        async for result in query_database_stream(req.qns):
+            yield orjson.dumps(result.model_dump(mode="json")) + b"\n"
+
+    return StreamingResponse(_result_lines(), media_type="application/x-ndjson")
 
 
 @app.post("/eval/relevance/")
@@ -93,10 +154,19 @@ async def eval_simple(res: Response):
     # small dummy embeddings (length mismatch with real model is acceptable for quick smoke test)
     dummy_embeddings = [[0.1] * 8, [0.2] * 8]
     result = await evaluate_query_relevance(dummy_query, dummy_embeddings)
-    return result
+    return ORJSONResponse(result.model_dump(mode="json"))
 
 
 @app.post("/eval/judge/")
 async def eval_judge(req: EvaluationQueryModel, res: Response):
     result = await evaluate_qns_ans_with_judge(req.query, req.expected_answer, req.ablation_config)
-    return result
+    return ORJSONResponse(result.model_dump(mode="json"))
+
+
+def _allows_cache(cache_control: str | None) -> bool:
+    # "Cache-Control: no-cache" or "no-store" forces the paper to be refetched
+    # and reextracted. The header may carry several comma separated directives
+    if cache_control is None:
+        return True
+    directives = {directive.strip().lower() for directive in cache_control.split(",")}
+    return CACHE_BYPASS_DIRECTIVES.isdisjoint(directives)
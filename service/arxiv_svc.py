@@ -1,21 +1,118 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import feedparser
+import httpx
 import pymupdf
-import requests
 
 from models.exceptions import PaperFetchError
 from models.models import PaperMetadata
 from service.embed_svc import embed_content
+from utils.cache import read_cache, write_cache
+from utils.logger import log
+from utils.utils import get_envvar
 
 ARXIV_BASE_URL = "http://export.arxiv.org/api/query?"
 ARXIV_BASE_PDF_URL = "https://arxiv.org/pdf/"
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
+ATOM_ENTRY_ID_PATH = f"{ATOM_NAMESPACE}entry/{ATOM_NAMESPACE}id"
+PDF_TEXT_CACHE_NAMESPACE = "pdf_text"
+METADATA_CACHE_NAMESPACE = "paper_metadata"
+METADATA_CACHE_MAXSIZE = 4096
+PDF_PAGES_PER_TASK = int(get_envvar("PDF_PAGES_PER_TASK", "16"))
+PDF_DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+_metadata_cache: OrderedDict[str, PaperMetadata] = OrderedDict()
+
+# Shared client so concurrent arXiv requests and downloads reuse pooled
+# keep-alive connections instead of paying a TLS handshake per request
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+    timeout=30,
+    follow_redirects=True,
+)
+
+# PDF parsing is CPU bound and holds the GIL, so run it in worker processes.
+# The pool is created on startup rather than at import, and its workers come
+# from a forkserver so they don't inherit the threads and sockets of the app
+PDF_PARSE_WORKERS = int(get_envvar("PDF_PARSE_WORKERS", str(os.cpu_count() or 1)))
+_pdf_pool: ProcessPoolExecutor | None = None
+
+
+async def close_http_client():
+    """Closes the shared HTTP client."""
+    await _http_client.aclose()
+
+
+def start_pdf_pool() -> ProcessPoolExecutor:
+    """Returns the PDF parsing worker pool, creating it on first use."""
+    global _pdf_pool
+
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _pdf_pool
+
+
+def shutdown_pdf_pool():
+    """Shuts down the PDF parsing worker processes."""
+    global _pdf_pool
+
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(cancel_futures=True)
+        _pdf_pool = None
+
+
+async def fetch_paper_metadata(paper_id: str, use_cache: bool = True) -> PaperMetadata:
+    """
+    Returns the paper metadata, from the in-memory or disk cache if present.
 
+    Args:
+        paper_id: arXiv id of the paper
+        use_cache: False to refetch from arXiv and refresh the cached entry
+    """
+    if use_cache and paper_id in _metadata_cache:
+        _metadata_cache.move_to_end(paper_id)
+        return _metadata_cache[paper_id]
+
+    # Old-style arXiv ids such as cs/0101001 contain a path separator
+    cache_key = paper_id.replace("/", "_")
+    cached = None
+    if use_cache:
+        cached = await asyncio.to_thread(
+            read_cache, METADATA_CACHE_NAMESPACE, cache_key
+        )
+    if cached is not None:
+        log.info(f"Paper metadata cache hit: {paper_id}")
+        paper_meta = PaperMetadata.model_validate_json(cached)
+    else:
+        paper_meta = await _fetch_paper_metadata_arxiv(paper_id)
+        await asyncio.to_thread(
+            write_cache,
+            METADATA_CACHE_NAMESPACE,
+            cache_key,
+            paper_meta.model_dump_json(),
+        )
+
+    _metadata_cache[paper_id] = paper_meta
+    _metadata_cache.move_to_end(paper_id)
+    if len(_metadata_cache) > METADATA_CACHE_MAXSIZE:
+        _metadata_cache.popitem(last=False)
+    return paper_meta
 
-async def fetch_paper_metadata(paper_id: str) -> PaperMetadata:
-    paper_meta = {}
+
+async def _fetch_paper_metadata_arxiv(paper_id: str) -> PaperMetadata:
     query_params = "id_list="
-    response = requests.get(f"{ARXIV_BASE_URL}{query_params}{paper_id}")
+    response = await _http_client.get(f"{ARXIV_BASE_URL}{query_params}{paper_id}")
     if response.status_code != 200:
         raise PaperFetchError("Failed to fetch paper metadata from arXiv.")
 
@@ -33,14 +130,14 @@ async def fetch_paper_metadata(paper_id: str) -> PaperMetadata:
     pdf_link = None
     for link in feed.entries[0].links:
         if link.type == "application/pdf":
-            paper_meta["pdf_url"] = link.href
             pdf_link = link.href
     if pdf_link is None:
         raise PaperFetchError("Paper PDF Link not found.")
 
     summary_embedding = await embed_content(summary)
 
-    paper_meta = PaperMetadata(
+    # Built from our own parsed feed and embedding, so skip revalidation
+    paper_meta = PaperMetadata.model_construct(
         id=paper_id,
         title=title,
         authors=authors,
@@ -53,32 +150,83 @@ async def fetch_paper_metadata(paper_id: str) -> PaperMetadata:
     return paper_meta
 
 
-def fetch_pdf_content(pdf_url: str) -> str:
-    response = requests.get(pdf_url)
-    if response.status_code != 200:
-        raise PaperFetchError(
-            "Failed to fetch PDF content.", status_code=response.status_code
+async def fetch_pdf_content(pdf_url: str) -> str:
+    # Stream the download to a temporary file, hashing it on the way, so the
+    # whole PDF is never held in memory and workers can open it by path
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete_on_close=False) as f:
+        pdf_hash = hashlib.sha256()
+        async with _http_client.stream("GET", pdf_url) as response:
+            if response.status_code != 200:
+                raise PaperFetchError(
+                    "Failed to fetch PDF content.", status_code=response.status_code
+                )
+            async for chunk in response.aiter_bytes(PDF_DOWNLOAD_CHUNK_SIZE):
+                pdf_hash.update(chunk)
+                f.write(chunk)
+        f.close()
+
+        pdf_hash = pdf_hash.hexdigest()
+        doc_text = await asyncio.to_thread(
+            read_cache, PDF_TEXT_CACHE_NAMESPACE, pdf_hash
         )
-    doc = pymupdf.Document(stream=response.content)
-    doc_text = chr(12).join([page.get_text() for page in doc])
+        if doc_text is not None:
+            log.info(f"PDF text cache hit: {pdf_hash}")
+            return doc_text
+
+        doc_text = await _parse_pdf_file(f.name)
+
+    await asyncio.to_thread(write_cache, PDF_TEXT_CACHE_NAMESPACE, pdf_hash, doc_text)
     return doc_text
 
 
-def fetch_document_id_by_topic(topic: str, num_papers: int) -> list:
+async def _parse_pdf_file(pdf_path: str) -> str:
+    # PyMuPDF is not thread safe, so long documents are split into page ranges
+    # that are parsed in parallel by separate worker processes
+    with pymupdf.open(pdf_path) as doc:
+        page_count = doc.page_count
+
+    loop = asyncio.get_running_loop()
+    pdf_pool = start_pdf_pool()
+    page_texts = await asyncio.gather(*[
+        loop.run_in_executor(
+            pdf_pool,
+            _parse_pdf_pages,
+            pdf_path,
+            start,
+            min(start + PDF_PAGES_PER_TASK, page_count),
+        )
+        for start in range(0, page_count, PDF_PAGES_PER_TASK)
+    ])
+    return chr(12).join(page_texts)
+
+
+def _parse_pdf_pages(pdf_path: str, start: int, end: int) -> str:
+    # Runs in a worker process, so it must stay a picklable top-level function
+    with pymupdf.open(pdf_path) as doc:
+        return chr(12).join([doc[i].get_text() for i in range(start, end)])
+
+
+async def fetch_document_id_by_topic(topic: str, num_papers: int) -> list:
     documents = []
     start = 0
     query = f"search_query=all:{topic}&start={start}&max_results={num_papers}"
-    response = requests.get(f"{ARXIV_BASE_URL}{query}")
+    response = await _http_client.get(f"{ARXIV_BASE_URL}{query}")
 
     if response.status_code != 200:
         raise PaperFetchError("Failed to fetch paper metadata from arXiv.")
 
-    feed = feedparser.parse(response.text)
+    # Only the entry ids are needed, so read them straight from the Atom XML
+    # with the C parser and only fall back to feedparser for malformed feeds
+    try:
+        root = ET.fromstring(response.content)
+        entry_ids = [entry_id.text for entry_id in root.iterfind(ATOM_ENTRY_ID_PATH)]
+    except ET.ParseError:
+        entry_ids = [entry.id for entry in feedparser.parse(response.text).entries]
 
     # Extract the document IDs per entry and formulate the PDF link
-    for entry in feed.entries:
+    for entry_id in entry_ids:
         doc = {}
-        doc["id"] = entry.id.split("/abs/")[-1]
+        doc["id"] = entry_id.split("/abs/")[-1]
         doc["pdf_link"] = f"{ARXIV_BASE_PDF_URL}{doc['id']}"
         documents.append(doc)
 
@@ -1,7 +1,7 @@
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from models.models import NodeRecord
-from service.embed_svc import embed_content
+from service.embed_svc import embed_batch
 from utils.logger import log
 
 text_splitter = RecursiveCharacterTextSplitter(
@@ -12,10 +12,9 @@ text_splitter = RecursiveCharacterTextSplitter(
 async def chunk_and_embed_text(content: str) -> list[NodeRecord]:
     log.info("Chunking and embedding")
     docs = text_splitter.split_text(content)
-    docs_content_with_embed = []
-    for chunk in docs:
-        embedding = await embed_content(chunk)
-        docs_content_with_embed.append(
-            NodeRecord(title=None, description=chunk, embedding=embedding)
-        )
-    return docs_content_with_embed
+    embeddings = await embed_batch(docs)
+
+    return [
+        NodeRecord.model_construct(title=None, description=chunk, embedding=embedding)
+        for chunk, embedding in zip(docs, embeddings)
+    ]
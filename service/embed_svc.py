@@ -1,24 +1,183 @@
+import asyncio
+from collections import OrderedDict
+
+import numpy as np
 from fastapi import HTTPException
 from openai import AsyncOpenAI, PermissionDeniedError
 
 from models.models import EmbeddingVector
+from utils.cache import content_hash, read_embeddings, write_embeddings
 from utils.logger import log
 from utils.utils import get_envvar
 
+EMBED_MODEL_NAME = get_envvar("EMBED_MODEL_NAME")
+# Largest number of inputs sent in a single embeddings request
+EMBED_BATCH_SIZE = int(get_envvar("EMBED_BATCH_SIZE", "96"))
+EMBED_CACHE_MAXSIZE = int(get_envvar("EMBED_CACHE_MAXSIZE", "10000"))
+# Largest number of embeddings requests in flight across all callers
+EMBED_MAX_CONCURRENCY = int(get_envvar("EMBED_MAX_CONCURRENCY", "8"))
+# Seconds a single embedding waits for others to share its request with
+EMBED_COALESCE_WAIT = float(get_envvar("EMBED_COALESCE_WAIT", "0.005"))
+
 embedding_client = AsyncOpenAI(
     base_url=get_envvar("OPENAI_COMPAT_EMBED_API_ENDPOINT"),
     api_key=get_envvar("OPENAI_COMPAT_EMBED_API_KEY"),
 )
 
+# In-memory tier in front of the on-disk embedding cache
+_embedding_cache: OrderedDict[str, EmbeddingVector] = OrderedDict()
+_embed_semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+# Single embeddings waiting to be sent together, by content
+_pending_embeddings: dict[str, asyncio.Future[EmbeddingVector]] = {}
+_pending_flush: asyncio.TimerHandle | None = None
+_flush_tasks: set[asyncio.Task] = set()
+
+
+async def close_embedding_client():
+    """Closes the embedding client and its connection pool."""
+    await embedding_client.close()
+
 
 async def embed_content(content: str) -> EmbeddingVector:
-    log.debug(f"Embedding: {len(content) > 40 and content[:40] + '...' or content}")
+    """
+    Embeds a single content. Contents not in the in-memory cache are held
+    for up to EMBED_COALESCE_WAIT seconds so that concurrent callers share
+    one embed_batch call.
+    """
+    global _pending_flush
+    log.debug("Embedding: %.40s", content)
+    key = _embedding_key(content)
+    if key in _embedding_cache:
+        _embedding_cache.move_to_end(key)
+        return _embedding_cache[key]
+
+    future = _pending_embeddings.get(content)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        _pending_embeddings[content] = future
+        if len(_pending_embeddings) >= EMBED_BATCH_SIZE:
+            if _pending_flush is not None:
+                _pending_flush.cancel()
+            _flush_pending_embeddings()
+        elif _pending_flush is None:
+            _pending_flush = loop.call_later(
+                EMBED_COALESCE_WAIT, _flush_pending_embeddings
+            )
+    # Shielded so that a cancelled caller does not cancel the others
+    return await asyncio.shield(future)
+
+
+def _flush_pending_embeddings():
+    global _pending_flush
+    _pending_flush = None
+    pending = dict(_pending_embeddings)
+    _pending_embeddings.clear()
+    task = asyncio.ensure_future(_embed_pending(pending))
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
+
+
+async def _embed_pending(pending: dict[str, asyncio.Future[EmbeddingVector]]):
     try:
-        embedding = await embedding_client.embeddings.create(
-            input=content,
-            model=get_envvar("EMBED_MODEL_NAME"),
+        embeddings = await embed_batch(list(pending))
+        for future, embedding in zip(pending.values(), embeddings):
+            if not future.done():
+                future.set_result(embedding)
+    except Exception as e:
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(e)
+    finally:
+        # Callers await these futures, so none may be left unresolved, even
+        # when the flush task itself is cancelled on shutdown
+        for future in pending.values():
+            if not future.done():
+                future.cancel()
+
+
+async def embed_batch(contents: list[str]) -> list[EmbeddingVector]:
+    """
+    Embeds the contents, only sending those not embedded by the same model
+    before, with one request per EMBED_BATCH_SIZE inputs and at most
+    EMBED_MAX_CONCURRENCY requests in flight.
+    """
+    keys = [_embedding_key(content) for content in contents]
+    embeddings = await _get_cached_embeddings(list(set(keys)))
+
+    missing = {
+        key: content for key, content in zip(keys, contents) if key not in embeddings
+    }
+    if missing:
+        log.debug("Embedding cache hits: %d/%d", len(embeddings), len(set(keys)))
+        # Batch contents of similar length together so that each request
+        # carries an even token count
+        missing_keys = sorted(missing, key=lambda key: len(missing[key]))
+        missing_contents = [missing[key] for key in missing_keys]
+        batches = [
+            missing_contents[i : i + EMBED_BATCH_SIZE]
+            for i in range(0, len(missing_contents), EMBED_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(*[_embed_batch_request(b) for b in batches])
+        new_embeddings = dict(
+            zip(missing_keys, [emb for result in results for emb in result])
         )
+        await _cache_embeddings(new_embeddings)
+        embeddings.update(new_embeddings)
+
+    return [embeddings[key] for key in keys]
+
+
+def _embedding_key(content: str) -> str:
+    return f"{EMBED_MODEL_NAME}:{content_hash(content)}"
+
+
+async def _get_cached_embeddings(keys: list[str]) -> dict[str, EmbeddingVector]:
+    found = {}
+    for key in keys:
+        if key in _embedding_cache:
+            _embedding_cache.move_to_end(key)
+            found[key] = _embedding_cache[key]
+
+    disk_keys = [key for key in keys if key not in found]
+    if disk_keys:
+        # SQLite reads block, so keep them off the event loop
+        stored = await asyncio.to_thread(read_embeddings, disk_keys)
+        disk_found = {
+            key: np.asarray(embedding, dtype=np.float32)
+            for key, embedding in stored.items()
+        }
+        _remember_embeddings(disk_found)
+        found.update(disk_found)
+    return found
+
+
+async def _cache_embeddings(entries: dict[str, EmbeddingVector]):
+    await asyncio.to_thread(write_embeddings, entries)
+    _remember_embeddings(entries)
+
+
+def _remember_embeddings(entries: dict[str, EmbeddingVector]):
+    _embedding_cache.update(entries)
+    while len(_embedding_cache) > EMBED_CACHE_MAXSIZE:
+        _embedding_cache.popitem(last=False)
+
+
+async def _embed_batch_request(contents: list[str]) -> list[EmbeddingVector]:
+    log.debug("Embedding batch of %d", len(contents))
+    try:
+        async with _embed_semaphore:
+            embedding = await embedding_client.embeddings.create(
+                input=contents,
+                model=EMBED_MODEL_NAME,
+            )
     except PermissionDeniedError:
-        raise HTTPException(status_code=500, detail=f"Failed to embed: {content}")
+        raise HTTPException(
+            status_code=500, detail=f"Failed to embed batch of {len(contents)}"
+        )
 
-    return embedding.data[0].embedding
+    # The response order is not guaranteed, so place by the returned index
+    return [
+        np.asarray(data.embedding, dtype=np.float32)
+        for data in sorted(embedding.data, key=lambda d: d.index)
+    ]
@@ -1,10 +1,9 @@
-from math import sqrt
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Optional
 
+import numpy as np
 from pydantic import BaseModel
 
 from service.embed_svc import embed_content
-from service.judge_svc import evaluate_response
 
 
 class EvaluationOutput(BaseModel):
@@ -12,16 +11,15 @@ class EvaluationOutput(BaseModel):
     judge: Optional[Dict[str, Any]] = None
 
 
-def _cosine(a: List[float], b: List[float]) -> float:
-    """Compute cosine similarity between two vectors (pure Python).
-    Returns 0.0 on error or zero-length vectors."""
-    try:
-        dot = sum(x * y for x, y in zip(a, b))
-        na = sqrt(sum(x * x for x in a))
-        nb = sqrt(sum(y * y for y in b))
-        return dot / (na * nb) if na and nb else 0.0
-    except Exception:
-        return 0.0
+def _cosine_scores(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """Compute the cosine similarity between the query and each candidate row.
+    Returns 0.0 for zero-length vectors."""
+    # Like the zip() based loop this replaces, vectors of different lengths
+    # are only compared over their common prefix
+    dim = min(query.shape[0], candidates.shape[1])
+    dots = candidates[:, :dim] @ query[:dim]
+    norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(query)
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
 
 
 async def evaluate_query_relevance(
@@ -29,23 +27,14 @@ async def evaluate_query_relevance(
 ) -> EvaluationOutput:
     """Embed query, compute cosine vs candidates, return best score as string."""
     q_emb = await embed_content(query_text)
+    # Candidates of different lengths cannot be stacked into one matrix, so
+    # they are scored in one matrix per length
+    candidates_by_dim: dict[int, list[list[float]]] = {}
+    for embedding in answer_embeddings:
+        candidates_by_dim.setdefault(len(embedding), []).append(embedding)
+
     best = 0.0
-    for emb in answer_embeddings:
-        score = _cosine(q_emb, emb)
-        if score > best:
-            best = score
+    for group in candidates_by_dim.values():
+        candidates = np.asarray(group, dtype=np.float32)
+        best = max(best, float(_cosine_scores(q_emb, candidates).max()))
     return EvaluationOutput(relevance_score=f"{best:.6f}")
-
-
-async def evaluate_with_judge(
-    query_text: str, system_answer: str, evidence: List[Dict[str, Any]]
-) -> EvaluationOutput:
-    """Call judge_svc.evaluate_response and package result into EvaluationOutput."""
-    judge_res = await evaluate_response(query_text, system_answer, evidence)
-    rel = (
-        judge_res.get("relevance", {}).get("score")
-        if isinstance(judge_res, dict)
-        else None
-    )
-    rel_str = f"{rel:.6f}" if isinstance(rel, float) else str(rel or "0.0")
-    return EvaluationOutput(relevance_score=rel_str, judge=judge_res)
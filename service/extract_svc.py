@@ -7,86 +7,101 @@ from pydantic_ai.models.openai import OpenAIChatModel
 from pydantic_ai.providers.openai import OpenAIProvider
 
 from models.models import NodeRecord
-from service.embed_svc import embed_content
+from service.embed_svc import embed_batch
 from utils.logger import log
 from utils.utils import get_envvar
 
+# Bump whenever the prompts or the extraction output change so that cached
+# extraction results from older versions are no longer reused
+EXTRACTOR_VERSION = "2"
+
 DATA_EXTRACTION_SYSTEM_PROMPT = "You are a highly skilled data extraction specialist. Your task is to extract datasets, techniques/methods covered as well as models used from research papers. Methods refer to techniques or approaches used in the research, while models refer to specific implementations or algorithms. Datasets refer to collections of data or benchmarks used for training or evaluation."
 
+# Paper independent part of the extraction prompt, appended to the paper text
+DATA_EXTRACTION_INSTRUCTIONS = """Extract the following from the paper:
+- datasets: datasets and benchmarks used for training or evaluation in the paper.
+- models: the models referenced, such as language models, rerank models, embed models, models that implements a technique or models used for comparison, in the paper. Exclude methods, benchmarks and framework.
+- methods: the terms of techniques used in the paper. Exclude language models, rerank models, embed models.
+- tasking: the tasks/use cases covered in the paper."""
+
 
 class ExtractionOutput(BaseModel):
     name: str
     description: str
 
 
-log.info(f"Extract Model set: {get_envvar('EXTRACT_MODEL_NAME')}")
+class PaperExtractionOutput(BaseModel):
+    datasets: list[ExtractionOutput]
+    models: list[ExtractionOutput]
+    methods: list[ExtractionOutput]
+    tasking: list[ExtractionOutput]
+
+
+EXTRACT_MODEL_NAME = get_envvar("EXTRACT_MODEL_NAME")
+
+log.info(f"Extract Model set: {EXTRACT_MODEL_NAME}")
 llm_model = OpenAIChatModel(
-    get_envvar("EXTRACT_MODEL_NAME"),
+    EXTRACT_MODEL_NAME,
     provider=OpenAIProvider(
         base_url=get_envvar("OPENAI_COMPAT_API_ENDPOINT"),
         api_key=get_envvar("OPENAI_COMPAT_API_KEY"),
     ),
 )
 
-data_extraction_agent = Agent(
+paper_extraction_agent = Agent(
     llm_model,
     system_prompt=DATA_EXTRACTION_SYSTEM_PROMPT,
-    output_type=PromptedOutput(list[ExtractionOutput]),
+    output_type=PromptedOutput(PaperExtractionOutput),
 )
 
 
-async def _extract_paper_content(prompt: str, error_message: str) -> list[NodeRecord]:
+async def _embed_extracted_terms(
+    extracted_terms: dict[str, list[ExtractionOutput]],
+) -> dict[str, list[NodeRecord]]:
+    # Embed the terms of every field with one batched request instead of a
+    # request per term, then hand the embeddings back out in the same order
+    names = [term.name for terms in extracted_terms.values() for term in terms]
+    embeddings = iter(await embed_batch(names))
+    return {
+        field: [
+            NodeRecord.model_construct(
+                title=term.name,
+                description=term.description,
+                embedding=next(embeddings),
+            )
+            for term in terms
+        ]
+        for field, terms in extracted_terms.items()
+    }
+
+
+async def extract_paper_all(paper_text: str) -> dict[str, list[NodeRecord]]:
+    """
+    Extracts the datasets, models, methods and tasking of the paper with a
+    single LLM call, so the paper text is only sent and billed once.
+
+    Returns:
+        The extracted records keyed by the PaperExtractedData field they fill
+    """
+    log.info("Extracting datasets, models, methods and tasking")
     time_start = time.perf_counter()
 
+    prompt = f"Given the following academic paper text:\n\n{paper_text}\n\n{DATA_EXTRACTION_INSTRUCTIONS}"
+
     try:
-        result = await data_extraction_agent.run(prompt)
+        result = await paper_extraction_agent.run(prompt)
     except ModelHTTPError as e:
         log.debug(e)
-        raise HTTPException(status_code=500, detail=error_message)
-
-    extracted_term = result.output
-    extracted_term_with_embed = []
-    for term in extracted_term:
-        term_embed = await embed_content(term.name)
-        extracted_term_with_embed.append(
-            NodeRecord(
-                title=term.name, description=term.description, embedding=term_embed
-            )
+        raise HTTPException(
+            status_code=500, detail="Failed to parse extracted paper data as JSON."
         )
 
+    output = result.output
+    extracted = await _embed_extracted_terms({
+        field: getattr(output, field) for field in PaperExtractionOutput.model_fields
+    })
+
     time_end = time.perf_counter()
     log.info(f"Completed in {time_end - time_start:.2f} seconds")
 
-    return extracted_term_with_embed
-
-
-async def extract_paper_dataset(paper_text: str) -> list[NodeRecord]:
-    log.info("Extracting datasets")
-    prompt = f"Given the following academic paper text:\n\n{paper_text}\n\nExtract datasets and benchmarks used for training or evaluation in the paper."
-    return await _extract_paper_content(
-        prompt, "Failed to parse extracted datasets as JSON."
-    )
-
-
-async def extract_paper_models(paper_text: str) -> list[NodeRecord]:
-    log.info("Extracting models")
-    prompt = f"Given the following academic paper text:\n\n{paper_text}\n\nExtract the models referenced, such as language models, rerank models, embed models, models that implements a technique or models used for comparison, in the paper. Exclude methods, benchmarks and framework."
-    return await _extract_paper_content(
-        prompt, "Failed to parse extracted models as JSON."
-    )
-
-
-async def extract_paper_methods(paper_text: str) -> list[NodeRecord]:
-    log.info("Extracting methods")
-    prompt = f"Given the following academic paper text:\n\n{paper_text}\n\nExtract the terms of techniques used in the paper. Exclude language models, rerank models, embed models."
-    return await _extract_paper_content(
-        prompt, "Failed to parse extracted methods as JSON."
-    )
-
-
-async def extract_paper_tasking(paper_text: str) -> list[NodeRecord]:
-    log.info("Extracting tasking")
-    prompt = f"Given the following academic paper text:\n\n{paper_text}\n\nExtract the tasks/use cases covered in the paper."
-    return await _extract_paper_content(
-        prompt, "Failed to parse extracted tasking as JSON."
-    )
+    return extracted
@@ -1,4 +1,6 @@
+import asyncio
 import re
+from functools import lru_cache
 from typing import Any, Dict, List
 
 from fastapi import HTTPException
@@ -14,12 +16,22 @@ from models.models import (
     QueryAnswerPair,
     RelevanceCheckModel,
 )
+from utils.cache import content_hash, read_cache, write_cache
 from utils.logger import log
 from utils.utils import get_envvar
 
-log.info(f"Judge Model set: {get_envvar('JUDGE_MODEL_NAME')}")
+SENTENCE_SPLIT_RE = re.compile(r"[.!?]\s*")
+WORD_RE = re.compile(r"\w+")
+
+JUDGE_MODEL_NAME = get_envvar("JUDGE_MODEL_NAME")
+# Bump whenever the judge prompts or tools change so that cached
+# evaluations from older versions are no longer reused
+JUDGE_VERSION = "1"
+JUDGE_CACHE_NAMESPACE = "judge_evaluations"
+
+log.info("Judge Model set: %s", JUDGE_MODEL_NAME)
 llm_model = OpenAIChatModel(
-    get_envvar("JUDGE_MODEL_NAME"),
+    JUDGE_MODEL_NAME,
     provider=OpenAIProvider(
         base_url=get_envvar("OPENAI_COMPAT_API_ENDPOINT"),
         api_key=get_envvar("OPENAI_COMPAT_API_KEY"),
@@ -27,54 +39,38 @@ llm_model = OpenAIChatModel(
 )
 judge_agent = Agent(
     llm_model,
+    # The output schema is enforced through NativeOutput, so the prompt does
+    # not need to spell out the JSON structure
     system_prompt="""You are an objective evaluator that evaluates the quality of a response to a question.
-
-You have FOUR tools available: groundedness_check, relevance_check, completeness_check, and accuracy_check.
-
-CRITICAL INSTRUCTIONS:
-1. You MUST call ALL FOUR tools
-2. After calling all four tools, return a JSON object with EXACTLY this structure:
-{
-    "groundedness_check": {
-        "support_claims": <number>,
-        "total_claims": <number>,
-        "grounded_ratio": <float between 0-1>,
-        "unsupported_examples": [<list of strings>]
-    },
-    "relevance_check": {
-        "score": <float between 0-1>,
-        "reasoning": "<string>"
-    },
-    "completeness_check": {
-        "score": <float between 0-1>,
-        "missing": [<list of strings>]
-    },
-    "accuracy_check": {
-        "is_accurate": <boolean>,
-        "reasoning": "<string>"
-    }
-}
-
-Do NOT add any extra fields. Do NOT add explanatory text outside the JSON structure. Simply call all four tools and populate the JSON with their results.""",
+You MUST call all four tools: groundedness_check, relevance_check, completeness_check and accuracy_check, then return their results without extra fields or text.""",
     output_type=NativeOutput(QAEvaluationModel),
     retries=3,
 )
 
 
+@lru_cache(maxsize=64)
+def _words(text: str) -> tuple[str, ...]:
+    """Lowercased word tokens of the text, shared by the tools since the judge
+    passes the same answer to several of them."""
+    return tuple(WORD_RE.findall(text.lower()))
+
+
 @judge_agent.tool
 def groundedness_check(
     ctx: RunContext[None], system_answer: str, evidence: List[Dict[str, Any]]
 ) -> GroundednessCheckModel:
     """Count sentences supported by any evidence snippet (simple substring heuristic)."""
-    log.info(
-        f"groundedness_check tool called with system_answer: {system_answer[:100]}..."
+    log.debug(
+        "groundedness_check tool called with system_answer: %.100s...", system_answer
     )
-    log.info(f"evidence count: {len(evidence)}")
-    sents = [s.strip() for s in re.split(r"[.!?]\s*", system_answer) if s.strip()]
+    log.debug("evidence count: %d", len(evidence))
+    sents = [s.strip() for s in SENTENCE_SPLIT_RE.split(system_answer) if s.strip()]
+    # Lowercase the evidence once and search it as a single string; the NUL
+    # separator keeps a sentence from matching across two snippets
+    evidence_text = "\0".join(ev.get("text", "").lower() for ev in evidence)
     supported, unsupported = 0, []
     for s in sents:
-        s_l = s.lower()
-        if any(s_l in (ev.get("text", "").lower()) for ev in evidence):
+        if s.lower() in evidence_text:
             supported += 1
         else:
             unsupported.append(s[:120])
@@ -85,7 +81,7 @@ def groundedness_check(
         grounded_ratio=supported / total,
         unsupported_examples=unsupported[:3],
     )
-    log.info(f"groundedness_check returning: {result}")
+    log.debug("groundedness_check returning: %s", result)
     return result
 
 
@@ -94,20 +90,20 @@ def relevance_check(
     ctx: RunContext[None], query_text: str, system_answer: str
 ) -> RelevanceCheckModel:
     """Simple token-overlap relevance score (0-1) and short reason."""
-    log.info(f"relevance_check tool called with query_text: {query_text}")
-    log.info(f"system_answer: {system_answer[:100]}...")
-    q = set(w for w in re.findall(r"\w+", query_text.lower()) if len(w) > 2)
-    a = set(w for w in re.findall(r"\w+", system_answer.lower()) if len(w) > 2)
+    log.debug("relevance_check tool called with query_text: %s", query_text)
+    log.debug("system_answer: %.100s...", system_answer)
+    q = set(w for w in _words(query_text) if len(w) > 2)
+    a = set(w for w in _words(system_answer) if len(w) > 2)
     if not q:
         result = RelevanceCheckModel(score=0.00, reasoning="no query tokens")
-        log.info(f"relevance_check returning (no query tokens): {result}")
+        log.debug("relevance_check returning (no query tokens): %s", result)
         return result
     inter = q & a
     score = len(inter) / len(q)
     result = RelevanceCheckModel(
         score=round(score, 3), reasoning=f"{len(inter)}/{len(q)} query tokens present"
     )
-    log.info(f"relevance_check returning: {result}")
+    log.debug("relevance_check returning: %s", result)
     return result
 
 
@@ -116,18 +112,18 @@ def completeness_check(
     ctx: RunContext[None], query_text: str, system_answer: str
 ) -> CompletenessCheckModel:
     """Heuristic completeness: fraction of query keywords present; list missing keywords."""
-    log.info(f"completeness_check tool called with query_text: {query_text}")
-    log.info(f"system_answer: {system_answer[:100]}...")
-    q = [w for w in re.findall(r"\w+", query_text.lower()) if len(w) > 3]
-    a = set(w for w in re.findall(r"\w+", system_answer.lower()) if len(w) > 3)
+    log.debug("completeness_check tool called with query_text: %s", query_text)
+    log.debug("system_answer: %.100s...", system_answer)
+    q = [w for w in _words(query_text) if len(w) > 3]
+    a = set(w for w in _words(system_answer) if len(w) > 3)
     if not q:
         result = CompletenessCheckModel(score=0.00, missing=[])
-        log.info(f"completeness_check returning (no query tokens): {result}")
+        log.debug("completeness_check returning (no query tokens): %s", result)
         return result
     missing = [w for w in q if w not in a]
     score = 1 - (len(missing) / len(set(q)))
     result = CompletenessCheckModel(score=round(score, 3), missing=missing[:6])
-    log.info(f"completeness_check returning: {result}")
+    log.debug("completeness_check returning: %s", result)
     return result
 
 
@@ -136,20 +132,20 @@ def accuracy_check(
     ctx: RunContext[None], expected_answer: str, actual_answer: str
 ) -> AccuracyCheckModel:
     """Check if the actual answer matches the expected answer semantically."""
-    log.info(f"accuracy_check tool called")
-    log.info(f"expected_answer: {expected_answer[:100]}...")
-    log.info(f"actual_answer: {actual_answer[:100]}...")
+    log.debug("accuracy_check tool called")
+    log.debug("expected_answer: %.100s...", expected_answer)
+    log.debug("actual_answer: %.100s...", actual_answer)
 
     # Simple heuristic: check token overlap
-    exp_tokens = set(w for w in re.findall(r"\w+", expected_answer.lower()) if len(w) > 2)
-    act_tokens = set(w for w in re.findall(r"\w+", actual_answer.lower()) if len(w) > 2)
+    exp_tokens = set(w for w in _words(expected_answer) if len(w) > 2)
+    act_tokens = set(w for w in _words(actual_answer) if len(w) > 2)
 
     if not exp_tokens:
         result = AccuracyCheckModel(
             is_accurate=False,
             reasoning="Expected answer has no valid tokens"
         )
-        log.info(f"accuracy_check returning (no expected tokens): {result}")
+        log.debug("accuracy_check returning (no expected tokens): %s", result)
         return result
 
     overlap = exp_tokens & act_tokens
@@ -160,38 +156,27 @@ def accuracy_check(
     reasoning = f"Token overlap: {len(overlap)}/{len(exp_tokens)} ({overlap_ratio:.1%})"
 
     result = AccuracyCheckModel(is_accurate=is_accurate, reasoning=reasoning)
-    log.info(f"accuracy_check returning: {result}")
+    log.debug("accuracy_check returning: %s", result)
     return result
 
 
-# async def evaluate_response(
-#     query_text: str, system_answer: str, evidence: List[Dict[str, Any]]
-# ) -> Dict[str, Any]:
-#     """Run the three simple tools and return combined result."""
-#     try:
-#         g = groundedness_check(None, system_answer, evidence)
-#         r = relevance_check(None, query_text, system_answer)
-#         c = completeness_check(None, query_text, system_answer)
-#         out = {"groundedness": g, "relevance": r, "completeness": c}
-#         log.info(
-#             f"Judge result: grounded={g['grounded_ratio']:.3f} rel={r['score']:.3f} comp={c['score']:.3f}"
-#         )
-#         return out
-#     except Exception as e:
-#         log.debug(f"evaluate_response failed: {e}")
-#         return {"error": str(e)}
-
-
 async def evaluate_response(qa_pair: QueryAnswerPair) -> QAEvaluationModel:
     log.info(f"Starting evaluation for query: {qa_pair.query}")
     log.info(f"Expected answer: {qa_pair.expected_answer}")
     log.info(f"Actual answer: {qa_pair.actual_answer}")
     log.info(f"Actual reasoning: {qa_pair.actual_reasoning}")
 
-    # Construct a comprehensive prompt with all evaluation data
-    prompt = f"""Please evaluate the quality of the following response to a question using all four available tools:
+    # Rerunning an evaluation set judges the same pairs again, so reuse the
+    # earlier evaluation instead of another full agent run
+    cache_key = (
+        f"{content_hash(qa_pair.model_dump_json() + JUDGE_MODEL_NAME)}-v{JUDGE_VERSION}"
+    )
+    cached = await asyncio.to_thread(read_cache, JUDGE_CACHE_NAMESPACE, cache_key)
+    if cached is not None:
+        log.info("Judge evaluation cache hit")
+        return QAEvaluationModel.model_validate_json(cached)
 
-QUESTION: {qa_pair.query}
+    prompt = f"""QUESTION: {qa_pair.query}
 
 EXPECTED ANSWER: {qa_pair.expected_answer}
 
@@ -199,15 +184,7 @@ SYSTEM ANSWER: {qa_pair.actual_answer}
 
 SYSTEM REASONING: {qa_pair.actual_reasoning}
 
-Your task:
-1. Use the groundedness_check tool to evaluate how well the system answer is supported by evidence
-2. Use the relevance_check tool to evaluate how relevant the system answer is to the question
-3. Use the completeness_check tool to evaluate how complete the system answer is
-4. Use the accuracy_check tool to compare the system answer against the expected answer
-
-For the groundedness_check tool, since no specific evidence is provided, use a placeholder empty list for the evidence parameter.
-
-Please call all four tools to complete the evaluation."""
+No evidence is provided, so pass an empty list as the groundedness_check evidence."""
 
     try:
         log.info("Calling judge agent with proper prompt...")
@@ -227,4 +204,8 @@ Please call all four tools to complete the evaluation."""
         log.error(f"Unexpected error in evaluate_response: {e}")
         log.error(f"Error type: {type(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    return result.output
+
+    await asyncio.to_thread(
+        write_cache, JUDGE_CACHE_NAMESPACE, cache_key, evaluation.model_dump_json()
+    )
+    return evaluation
@@ -1,30 +1,107 @@
-from typing import Any, List
+import logging
+import time
+from functools import cache
+from typing import Any
 
 from neo4j import Driver, GraphDatabase, Query
+from neo4j.exceptions import ClientError
+from neo4j.graph import Node
 from neo4j.time import Date, DateTime, Duration, Time
 
-from models.models import EmbeddingVector, PaperExtractedData, PaperMetadata
+from models.models import (
+    EmbeddingVector,
+    PaperExtractedData,
+    PaperMetadata,
+)
 from utils.logger import log
 from utils.utils import get_envvar
 
 DATABASE_NAME = get_envvar("NEO4J_DATABASE_NAME")
-
+MAX_CONNECTION_POOL_SIZE = int(get_envvar("NEO4J_MAX_CONNECTION_POOL_SIZE", "50"))
+CONNECTION_ACQUISITION_TIMEOUT = float(
+    get_envvar("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", "30")
+)
+# How long execute_write keeps retrying transient failures such as deadlocks
+MAX_TRANSACTION_RETRY_TIME = float(get_envvar("NEO4J_MAX_TRANSACTION_RETRY_TIME", "30"))
+
+# (label, property) pairs that nodes are looked up or merged by
+LOOKUP_INDEXES = (
+    ("Paper", "id"),
+    ("Author", "name"),
+    ("Dataset", "title"),
+    ("Model", "title"),
+    ("Method", "title"),
+    ("Task", "title"),
+)
+
+# The schema only changes when new labels or relation types are written
+SCHEMA_CACHE_TTL = float(get_envvar("NEO4J_SCHEMA_CACHE_TTL", "300"))
+
+# Ids of papers already known to be stored in the graph
+_known_paper_ids: set[str] = set()
+_schema_cache: tuple[str, float] | None = None
+# Bumped by ingestion whenever its writes may have changed the schema
+_schema_version = 0
+
+# Nodes come back without their embedding, which would otherwise be sent to
+# the query agent as thousands of floats per node, but with their labels
 VECTOR_SEARCH_CYPHER_TEXT = """
     CALL db.index.vector.queryNodes($index_name, $top_k, $query_embedding)
     YIELD node, score
-    RETURN node, score
+    RETURN node {.*, embedding: null} AS node, labels(node) AS labels, score
     ORDER BY score DESC
 """
 
+# Opens a query written by the query agent, which continues from each
+# matching node as `seed` and its similarity as `score`. The seed stays a node
+# so the query can MATCH from it, and serialize_neo4j_types drops its embedding
+# should the query return it whole
+SEEDED_QUERY_CYPHER_PREFIX = """
+    CALL db.index.vector.queryNodes($index_name, $top_k, $query_embedding)
+    YIELD node AS seed, score
+    WHERE none(label IN labels(seed) WHERE label IN $excluded_labels)
+"""
+
 
+def _to_param(embedding: EmbeddingVector) -> list[float]:
+    """Converts an embedding array to the list type the driver sends."""
+    return embedding.tolist()
+
+
+@cache
 def get_neo4j_driver() -> Driver:
-    """Returns a Neo4j driver instance."""
+    """Returns the Neo4j driver instance shared by the whole process."""
     return GraphDatabase.driver(
         get_envvar("NEO4J_ENDPOINT"),
         auth=(get_envvar("NEO4J_USER"), get_envvar("NEO4J_PASSWORD")),
+        max_connection_pool_size=MAX_CONNECTION_POOL_SIZE,
+        connection_acquisition_timeout=CONNECTION_ACQUISITION_TIMEOUT,
+        max_transaction_retry_time=MAX_TRANSACTION_RETRY_TIME,
     )
 
 
+def ensure_lookup_indexes():
+    """Creates the range indexes backing the exact-match node lookups, if missing."""
+    driver = get_neo4j_driver()
+    with driver.session(database=DATABASE_NAME) as session:
+        for label, id_property in LOOKUP_INDEXES:
+            try:
+                session.run(
+                    f"CREATE INDEX {label.lower()}_{id_property}_index IF NOT EXISTS "
+                    f"FOR (n:{label}) ON (n.{id_property})"
+                )
+            except ClientError as e:
+                # e.g. a uniqueness constraint already indexes the property
+                log.debug(e)
+
+
+def close_neo4j_driver():
+    """Closes the shared Neo4j driver if it has been created."""
+    if get_neo4j_driver.cache_info().currsize:
+        get_neo4j_driver().close()
+        get_neo4j_driver.cache_clear()
+
+
 def find_or_create_vector_node(
     tx,
     label: str,
@@ -32,33 +109,39 @@ def find_or_create_vector_node(
     node_id: str,
     title: str,
     description: str,
-    embedding: List[float],
+    embedding: EmbeddingVector,
     threshold: float = 0.94,
 ):
     """
     Uses Neo4j vector index to find semantically similar node.
     Deduplicates using explicit ID or high cosine similarity.
+
+    Returns:
+        The id of the matched or created node, as {"id": ...}
     """
+    embedding = _to_param(embedding)
 
-    # Check if node exists
+    # Check if node exists. Only the id is returned, since the matched node
+    # would otherwise be sent back with its whole embedding
     exact_match = tx.run(
-        f"MATCH (n:{label} {{{id_property}: $node_id}}) RETURN n LIMIT 1",
+        f"MATCH (n:{label} {{{id_property}: $node_id}}) "
+        f"RETURN n.{id_property} AS id LIMIT 1",
         node_id=node_id,
-    ).data()
+    ).single(strict=False)
     if exact_match:
-        return exact_match[0]["n"]
+        return {"id": exact_match["id"]}
 
     # Check if similar node with extremely high similarity score exists
     index_name = f"{label.lower()}_vector_index"
     query = f"""
     CALL db.index.vector.queryNodes('{index_name}', 1, $embedding)
     YIELD node, score
-    RETURN node, score
+    RETURN node.{id_property} AS id, score
     """
-    result = tx.run(query, embedding=embedding).data()
+    result = tx.run(query, embedding=embedding).single(strict=False)
 
-    if result and result[0]["score"] >= threshold:
-        return result[0]["node"]
+    if result and result["score"] >= threshold:
+        return {"id": result["id"]}
 
     # Create a fresh node if node not already in
     tx.run(
@@ -79,13 +162,14 @@ def find_or_create_vector_node(
 
 
 def create_similarity_links(
-    tx, label: str, node_id: str, embedding: List[float], top_k=5, threshold=0.9
+    tx, label: str, node_id: str, embedding: EmbeddingVector, top_k=5, threshold=0.9
 ):
     """
     Creates :SIMILAR_TO relationships between semantically close nodes
     using the label's vector index.
     """
     index_name = f"{label.lower()}_vector_index"
+    embedding = _to_param(embedding)
 
     tx.run(
         f"""
@@ -102,10 +186,10 @@ def create_similarity_links(
     )
 
 
-def store_paper_node(session, meta: PaperMetadata):
+def store_paper_node(tx, meta: PaperMetadata):
     """Creates or updates the Paper node."""
     log.info("Creating/updating paper node...")
-    session.run(
+    tx.run(
         """
         MERGE (p:Paper {id: $id})
         SET p.title = $title,
@@ -119,46 +203,60 @@ def store_paper_node(session, meta: PaperMetadata):
         summary=meta.summary,
         date_published=meta.date_published,
         date_updated=meta.date_updated,
-        embedding=meta.embedding,
+        embedding=_to_param(meta.embedding),
     )
     log.info("Created/updated paper node.")
 
 
-def store_authors(session, meta: PaperMetadata):
+def store_authors(tx, meta: PaperMetadata):
     """Creates Author nodes and links them to the Paper."""
     log.info("Creating author node...")
-    for author in meta.authors:
-        session.run(
-            """
-            MERGE (a:Author {name: $name})
-            WITH a
-            MATCH (p:Paper {id: $paper_id})
-            MERGE (p)-[:WRITTEN_BY]->(a)
-            """,
-            name=author,
-            paper_id=meta.id,
-        )
+    tx.run(
+        """
+        MATCH (p:Paper {id: $paper_id})
+        UNWIND $names AS name
+        MERGE (a:Author {name: name})
+        MERGE (p)-[:WRITTEN_BY]->(a)
+        """,
+        names=meta.authors,
+        paper_id=meta.id,
+    )
     log.info("Created author node.")
 
 
-def store_content_chunks(session, pdf_data: PaperExtractedData, paper_id: str):
+def store_content_chunks(tx, pdf_data: PaperExtractedData, paper_id: str):
     """Creates Content chunk nodes and links them to the Paper."""
     log.info("Creating chunk nodes...")
-    for chunk in pdf_data.content:
-        session.run(
-            """
-            CREATE (c:Content {description: $description, embedding: $embedding})
-            WITH c
-            MATCH (p:Paper {id: $paper_id})
-            MERGE (p)-[:CONTAINS_CHUNK]->(c)
-            """,
-            description=chunk.description,
-            embedding=chunk.embedding,
-            paper_id=paper_id,
-        )
+    tx.run(
+        """
+        MATCH (p:Paper {id: $paper_id})
+        UNWIND $chunks AS chunk
+        MERGE (p)-[:CONTAINS_CHUNK]->(c:Content {description: chunk.description})
+        SET c.embedding = chunk.embedding
+        """,
+        chunks=[
+            {
+                "description": chunk.description,
+                "embedding": _to_param(chunk.embedding),
+            }
+            for chunk in pdf_data.content
+        ],
+        paper_id=paper_id,
+    )
     log.info("Created chunk nodes.")
 
 
+def store_paper_records(tx, meta: PaperMetadata, pdf_data: PaperExtractedData):
+    """
+    Stores the Paper node with its authors, content chunks and similarity links
+    within a single transaction.
+    """
+    store_paper_node(tx, meta)
+    store_authors(tx, meta)
+    store_content_chunks(tx, pdf_data, meta.id)
+    store_paper_similarity_links(tx, meta)
+
+
 def store_semantic_entities(session, pdf_data: PaperExtractedData, paper_id: str):
     """Creates Dataset, Model, Method, and Task nodes with semantic links."""
     log.info("Creating dataset, model, method, task nodes...")
@@ -171,9 +269,13 @@ def store_semantic_entities(session, pdf_data: PaperExtractedData, paper_id: str
 
     for label, rel, node_list, id_prop in mapping:
         log.info(f"Creating {label} nodes, with the {rel} relation...")
+        # Entities deduplicated onto an existing node are linked through that
+        # node's id, which may differ from their own title
+        kept_nodes: dict[str, EmbeddingVector] = {}
         for node in node_list:
-            # Create or find similar node (by title or embedding)
-            session.execute_write(
+            # One transaction per entity, so the next entity's deduplication
+            # sees this one in the vector index
+            kept = session.execute_write(
                 find_or_create_vector_node,
                 label,
                 id_prop,
@@ -183,34 +285,77 @@ def store_semantic_entities(session, pdf_data: PaperExtractedData, paper_id: str
                 node.embedding,
                 0.95,
             )
-            # Link to the paper
-            session.run(
-                f"""
-                MATCH (p:Paper {{id: $paper_id}})
-                MATCH (n:{label} {{{id_prop}: $node_id}})
-                MERGE (p)-[:{rel}]->(n)
-                """,
-                paper_id=paper_id,
-                node_id=node.title,
-            )
-
-            # Build similarity links among same-label nodes
+            kept_nodes.setdefault(kept["id"], node.embedding)
+        if kept_nodes:
             session.execute_write(
-                create_similarity_links,
-                label,
-                node.title,
-                node.embedding,
-                5,
-                0.9,
+                link_semantic_entities, label, rel, id_prop, kept_nodes, paper_id
             )
         log.info(f"Created {label} nodes, with the {rel} relation.")
 
 
-def store_paper_similarity_links(session, meta: PaperMetadata):
+def link_semantic_entities(
+    tx,
+    label: str,
+    rel: str,
+    id_prop: str,
+    nodes: dict[str, EmbeddingVector],
+    paper_id: str,
+    top_k: int = 5,
+    threshold: float = 0.9,
+):
+    """
+    Links the entity nodes of one label to the Paper and builds similarity
+    links among same-label nodes, with a single statement for all of them.
+
+    Args:
+        nodes: Embedding of the extracted entity, keyed on the id of the node
+            it was stored as or deduplicated onto
+    """
+    # The similarity search runs in a unit subquery, so a node without similar
+    # neighbours still counts as linked
+    result = tx.run(
+        f"""
+        MATCH (p:Paper {{id: $paper_id}})
+        UNWIND $nodes AS row
+        MATCH (n:{label} {{{id_prop}: row.node_id}})
+        MERGE (p)-[:{rel}]->(n)
+        WITH n, row
+        CALL {{
+            WITH n, row
+            CALL db.index.vector.queryNodes(
+                '{label.lower()}_vector_index', $k, row.embedding
+            )
+            YIELD node, score
+            WHERE node.{id_prop} <> row.node_id AND score > $threshold
+            MERGE (n)-[:SIMILAR_TO {{score: score}}]->(node)
+        }}
+        RETURN collect(row.node_id) AS linked
+        """,
+        nodes=[
+            {"node_id": node_id, "embedding": _to_param(embedding)}
+            for node_id, embedding in nodes.items()
+        ],
+        paper_id=paper_id,
+        k=top_k,
+        threshold=threshold,
+    ).single()
+
+    unlinked = set(nodes) - set(result["linked"])
+    if unlinked:
+        log.warning(
+            "Could not link %d %s node(s) to paper %s: %s",
+            len(unlinked),
+            label,
+            paper_id,
+            sorted(unlinked),
+        )
+
+
+def store_paper_similarity_links(tx, meta: PaperMetadata):
     """Creates similarity links between papers."""
     log.info("Building similarity links between papers...")
-    session.execute_write(
-        create_similarity_links,
+    create_similarity_links(
+        tx,
         "Paper",
         meta.id,
         meta.embedding,
@@ -221,8 +366,14 @@ def store_paper_similarity_links(session, meta: PaperMetadata):
 
 
 def serialize_neo4j_types(obj: Any) -> Any:
-    """Convert Neo4j types to JSON-serializable Python types"""
-    if isinstance(obj, (DateTime, Date, Time)):
+    """Convert Neo4j types to JSON-serializable Python types.
+
+    Nodes become a dict of their properties without the embedding, which would
+    otherwise reach the query agent as thousands of floats per node.
+    """
+    if isinstance(obj, Node):
+        return {k: serialize_neo4j_types(v) for k, v in obj.items() if k != "embedding"}
+    elif isinstance(obj, (DateTime, Date, Time)):
         return obj.iso_format()
     elif isinstance(obj, Duration):
         return str(obj)
@@ -235,15 +386,79 @@ def serialize_neo4j_types(obj: Any) -> Any:
 
 
 def get_graph_schema() -> str:
-    """Retrieve Neo4j graph schema with property mappings"""
+    """Retrieve Neo4j graph schema with property mappings, cached for SCHEMA_CACHE_TTL seconds"""
+    global _schema_cache
+    if _schema_cache is not None:
+        schema, fetched_at = _schema_cache
+        if time.monotonic() - fetched_at < SCHEMA_CACHE_TTL:
+            return schema
+
+    schema = _fetch_graph_schema()
+    _schema_cache = (schema, time.monotonic())
+    return schema
+
+
+def invalidate_graph_schema():
+    """Drop the cached schema after writes that may have changed it"""
+    global _schema_cache, _schema_version
+    _schema_cache = None
+    _schema_version += 1
+
+
+def get_graph_schema_version() -> int:
+    """Version of the schema, changing whenever it is invalidated"""
+    return _schema_version
+
+
+def _fetch_relationship_types(session) -> list[tuple[str, str, str]]:
+    """
+    Returns the (type, start label, end label) triples present in the graph.
+
+    The schema visualization is derived from the count store, so unlike
+    matching every relationship it does not scan the graph. The count store
+    only counts the start and the end labels of a type separately, though, so
+    a type with several labels at both ends, such as SIMILAR_TO, is reported
+    with every pairing of them. Only those pairings are checked against the
+    graph, each with a LIMIT 1 match.
+    """
+    record = session.run("CALL db.schema.visualization()").single()
+    candidates = {
+        (
+            rel.type,
+            next(iter(rel.start_node.labels)),
+            next(iter(rel.end_node.labels)),
+        )
+        for rel in record["relationships"]
+    }
+
+    start_labels: dict[str, set[str]] = {}
+    end_labels: dict[str, set[str]] = {}
+    for rel_type, from_label, to_label in candidates:
+        start_labels.setdefault(rel_type, set()).add(from_label)
+        end_labels.setdefault(rel_type, set()).add(to_label)
+
+    rel_types = []
+    for rel_type, from_label, to_label in candidates:
+        if len(start_labels[rel_type]) > 1 and len(end_labels[rel_type]) > 1:
+            pattern = f"(:`{from_label}`)-[:`{rel_type}`]->(:`{to_label}`)"
+            if session.run(f"MATCH {pattern} RETURN 1 LIMIT 1").single() is None:
+                continue
+        rel_types.append((rel_type, from_label, to_label))
+    return sorted(rel_types)
+
+
+def _fetch_graph_schema() -> str:
     driver = get_neo4j_driver()
     with driver.session(database=DATABASE_NAME) as session:
         # Get detailed schema for each node label
         schema_parts = ["Graph Schema:\n"]
 
-        # Get node labels
+        # Get node labels. Everything listed below is sorted so that the
+        # schema, and the query prompts it opens, are byte-identical across
+        # processes and restarts, which lets the LLM provider reuse its
+        # cached prompt prefix
         node_result = session.run("CALL db.labels()")
-        labels = [record[0] for record in node_result]
+        labels = sorted(record[0] for record in node_result)
 
         # For each label, get sample properties
         schema_parts.append("Node Types:")
@@ -252,24 +467,15 @@ def get_graph_schema() -> str:
             sample = session.run(f"MATCH (n:{label}) RETURN n LIMIT 1")
             record = sample.single()
             if record:
-                props = list(record["n"].keys())
+                props = sorted(record["n"].keys())
                 schema_parts.append(f"  - {label}: {{{', '.join(props)}}}")
             else:
                 schema_parts.append(f"  - {label}")
 
         # Get relationship types with start/end node info
         schema_parts.append("\nRelationship Types:")
-        rel_query = """
-            MATCH (a)-[r]->(b)
-            WITH type(r) as rel_type, labels(a)[0] as from_label, labels(b)[0] as to_label
-            RETURN DISTINCT rel_type, from_label, to_label
-            ORDER BY rel_type
-            """
-        rel_result = session.run(rel_query)
-        for record in rel_result:
-            schema_parts.append(
-                f"  - ({record['from_label']})-[{record['rel_type']}]->({record['to_label']})"
-            )
+        for rel_type, from_label, to_label in _fetch_relationship_types(session):
+            schema_parts.append(f"  - ({from_label})-[{rel_type}]->({to_label})")
 
         # Get vector indexes
         try:
@@ -285,7 +491,7 @@ def get_graph_schema() -> str:
 
             if vector_indexes:
                 schema_parts.append("\nVector Indexes:")
-                for idx in vector_indexes:
+                for idx in sorted(vector_indexes):
                     schema_parts.append(f"  - {idx}")
         except Exception:
             # If SHOW INDEXES fails, skip vector index info
@@ -304,9 +510,9 @@ def process_query(cypher_query: str, cache_func=None) -> list[dict[str, Any]]:
         if cache_func:
             cache_func(cypher_query, records)
 
-        log.debug(f"Query returned {len(records)} record(s)")
+        log.debug("Query returned %d record(s)", len(records))
         if records:
-            log.debug(f"Sample result: {records[0]}")
+            log.debug("Sample result: %s", records[0])
 
         return records
 
@@ -318,7 +524,6 @@ def process_vector_search(
     query_text: str,
     cache_func=None,
 ) -> list[dict[str, Any]]:
-    driver = get_neo4j_driver()
     # Perform vector search using Neo4j's vector index
     driver = get_neo4j_driver()
     with driver.session(database=DATABASE_NAME) as session:
@@ -328,23 +533,25 @@ def process_vector_search(
             cypher_query,
             index_name=index_name,
             top_k=top_k,
-            query_embedding=query_embedding,
+            query_embedding=_to_param(query_embedding),
         )
         records = [
             {
-                "node": serialize_neo4j_types(dict(record["node"])),
+                "node": serialize_neo4j_types({
+                    k: v for k, v in record["node"].items() if v is not None
+                }),
+                "labels": record["labels"],
                 "score": record["score"],
             }
             for record in result
         ]
 
         if cache_func:
-            cache_query = f"{query_text}|{index_name}|{top_k}"
-            cache_func(cache_query, records)
+            cache_func((query_text, index_name, top_k), records)
 
-        log.debug(f"Vector search returned {len(records)} result(s)")
-        if records:
-            log.debug(f"Top result (score: {records[0]['score']:.4f}):")
+        log.debug("Vector search returned %d result(s)", len(records))
+        if records and log.isEnabledFor(logging.DEBUG):
+            log.debug("Top result (score: %.4f):", records[0]["score"])
             # Show key fields from the node
             node = records[0]["node"]
             for key in ["title", "name", "content", "abstract"]:
@@ -352,14 +559,60 @@ def process_vector_search(
                     value = node[key]
                     if isinstance(value, str) and len(value) > 100:
                         value = value[:100] + "..."
-                    log.debug(f"  {key}: {value}")
+                    log.debug("  %s: %s", key, value)
+
+        return records
+
+
+def process_seeded_query(
+    index_name: str,
+    top_k: int,
+    query_embedding: EmbeddingVector,
+    cypher_query: str,
+    excluded_labels: list[str],
+) -> list[dict[str, Any]]:
+    """
+    Runs the vector search and the traversal from its matches as a single
+    query, so the seed nodes never make a round trip through the caller.
+    """
+    driver = get_neo4j_driver()
+    with driver.session(database=DATABASE_NAME) as session:
+        result = session.run(
+            SEEDED_QUERY_CYPHER_PREFIX + cypher_query,
+            index_name=index_name,
+            top_k=top_k,
+            query_embedding=_to_param(query_embedding),
+            excluded_labels=excluded_labels,
+        )
+        records = [serialize_neo4j_types(dict(record)) for record in result]
+
+        log.debug("Seeded query returned %d record(s)", len(records))
+        if records:
+            log.debug("Sample result: %s", records[0])
 
         return records
 
 
 def check_paper_exists(paper_id: str) -> bool:
-    query = f'MATCH (p:Paper) WHERE p.id CONTAINS "{paper_id}" RETURN *'
+    # Papers are never removed by the pipeline, so only a positive answer can
+    # be remembered; a missing paper may be added right after the check
+    if paper_id in _known_paper_ids:
+        return True
+
     driver = get_neo4j_driver()
     with driver.session(database=DATABASE_NAME) as session:
-        result = session.run(query)
-        return result.single(strict=False) is not None
+        # Papers are stored under their versioned arXiv id, e.g. 2301.00001v1,
+        # while callers may pass the bare id. Both forms use the Paper.id index
+        result = session.run(
+            """
+            MATCH (p:Paper)
+            WHERE p.id = $paper_id OR p.id STARTS WITH $paper_id + 'v'
+            RETURN 1 LIMIT 1
+            """,
+            paper_id=paper_id,
+        )
+        exists = result.single(strict=False) is not None
+
+    if exists:
+        _known_paper_ids.add(paper_id)
+    return exists
@@ -1,22 +1,55 @@
-import hashlib
+import asyncio
 import json
 import re
 import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Hashable
+from contextvars import ContextVar
+from functools import lru_cache
 from typing import Any, Optional
 
-from pydantic import BaseModel, Field
+import numpy as np
+from pydantic import BaseModel, ConfigDict, Field
 from pydantic_ai import Agent, RunContext, UsageLimits
 from pydantic_ai.models.openai import OpenAIChatModel
 from pydantic_ai.providers.openai import OpenAIProvider
 
 from models.models import AblationConfig
 from service.embed_svc import embed_content
-from service.neo4j_svc import get_graph_schema, process_query, process_vector_search
+from service.neo4j_svc import (
+    get_graph_schema,
+    get_graph_schema_version,
+    process_query,
+    process_seeded_query,
+    process_vector_search,
+)
 from utils.logger import log
-from utils.utils import get_envvar
+from utils.utils import get_envflag, get_envvar
 
-CACHE_ENABLE: bool = bool(get_envvar("QUERY_CACHE_ENABLE"))
+CACHE_ENABLE: bool = get_envflag("QUERY_CACHE_ENABLE")
 CACHE_TTL: int = int(get_envvar("QUERY_CACHE_TTL"))
+CACHE_MAXSIZE: int = int(get_envvar("QUERY_CACHE_MAXSIZE", "1024"))
+# Reusing the answer of a similar question can hand back the answer to a
+# question about a different entity, so it is opt-in
+SEMANTIC_CACHE_ENABLE: bool = get_envflag("QUERY_SEMANTIC_CACHE_ENABLE", "false")
+# Questions at least this similar to a cached one reuse its answer
+SEMANTIC_CACHE_THRESHOLD: float = float(get_envvar("QUERY_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAXSIZE: int = int(get_envvar("QUERY_SEMANTIC_CACHE_MAXSIZE", "256"))
+QUERY_MODEL_SETTINGS: dict[str, Any] = json.loads(get_envvar("QUERY_MODEL_SETTINGS"))
+# Largest number of questions of a batch_query answered at once
+QUERY_MAX_CONCURRENCY: int = int(get_envvar("QUERY_MAX_CONCURRENCY", "16"))
+# Text properties of vector search hits longer than this are cut short, 0 keeps them whole
+VECTOR_RESULT_MAX_CHARS: int = int(get_envvar("QUERY_VECTOR_RESULT_MAX_CHARS", "500"))
+
+DEBUG_SEPARATOR = "=" * 60
+MATCH_VARIABLE_RE = re.compile(r'MATCH\s+\((\w+)')
+
+# The system prompts below are templates, filled in with the schema when an
+# agent is created. The schema is fetched once, and again only after
+# ingestion has invalidated it
+GRAPH_SCHEMA_PLACEHOLDER = "{graph_schema}"
+_graph_schema: str = get_graph_schema()
+_graph_schema_version: int = get_graph_schema_version()
 
 
 def _get_base_prompt_rules() -> str:
@@ -45,7 +78,7 @@ WHAT NOT TO DO (violations will waste resources):
 NEO4J_QUERY_SYSTEM_PROMPT_FULL = f"""
 You are a Neo4j graph database expert with access to both Cypher queries and vector similarity search.
 
-{get_graph_schema()}
+{GRAPH_SCHEMA_PLACEHOLDER}
 
 {_get_base_prompt_rules()}
 
@@ -53,6 +86,7 @@ QUERY STRATEGY (follow in order):
 Step 1: Determine what type of query you need:
    - Semantic search needed (e.g., "papers about X", "datasets for Y")? → Use vector_search ONCE
    - Known entity with direct relationships? → Use query_neo4j ONCE with a comprehensive query
+   - Semantic search, then relationships of the matches (e.g., "papers that use datasets for Y")? → Use vector_graph_query ONCE, it does both in one call
 
 Step 2: If you used vector_search and need more details:
    - Write ONE comprehensive query_neo4j that gets ALL needed information
@@ -66,7 +100,7 @@ Remember: 1-3 tool calls is ideal. Stop as soon as you can answer the question.
 NEO4J_QUERY_SYSTEM_PROMPT_VECTOR_ONLY = f"""
 You are a semantic search expert with access to vector similarity search over a Neo4j graph database.
 
-{get_graph_schema()}
+{GRAPH_SCHEMA_PLACEHOLDER}
 
 {_get_base_prompt_rules()}
 
@@ -85,7 +119,7 @@ Remember: You only have vector search, so get the most relevant results in ONE c
 NEO4J_QUERY_SYSTEM_PROMPT_CYPHER_ONLY = f"""
 You are a Neo4j Cypher query expert with access to a graph database.
 
-{get_graph_schema()}
+{GRAPH_SCHEMA_PLACEHOLDER}
 
 {_get_base_prompt_rules()}
 
@@ -120,14 +154,27 @@ Remember: No tools available - provide your answer immediately based on general
 
 
 class GraphQueryResult(BaseModel):
+    # Cached answers are handed to every caller whose question matches, so
+    # one caller must not be able to change the answer the others get
+    model_config = ConfigDict(frozen=True)
+
     reasoning: str = Field(
         description="The reasoning process including traversal hops in format: 'Node1 (Type)' -> 'Node2 (Type)' -> 'Node3 (Type)'"
     )
     answer: str = Field(description="Natural language answer to the question")
 
 
-_query_cache: dict[str, tuple[list[dict[str, Any]], float]] = {}
-_vector_cache: dict[str, tuple[list[dict[str, Any]], float]] = {}
+# Keyed by the query string itself, which the dict hashes once and caches,
+# and by (query text, index name, top_k) for vector searches.
+# Entries are kept least recently used first and capped at CACHE_MAXSIZE
+_query_cache: OrderedDict[str, tuple[list[dict[str, Any]], float]] = OrderedDict()
+_vector_cache: OrderedDict[
+    tuple[str, str, int], tuple[list[dict[str, Any]], float]
+] = OrderedDict()
+# Agents by (enable_graphrag, enable_vector_search, enable_cypher_queries)
+_agent_cache: dict[tuple[bool, bool, bool], Agent] = {}
+# (ablation config, normalized question embedding, answer, timestamp), oldest first
+_answer_cache: list[tuple[str, np.ndarray, GraphQueryResult, float]] = []
 
 log.info(f"Query Model set: {get_envvar('QUERY_MODEL_NAME')}")
 llm_model = OpenAIChatModel(
@@ -138,6 +185,39 @@ llm_model = OpenAIChatModel(
     ),
 )
 
+
+async def _refresh_graph_schema():
+    """Rebuild the agents when ingestion has changed the schema their prompts describe"""
+    global _graph_schema, _graph_schema_version
+    version = get_graph_schema_version()
+    if version == _graph_schema_version:
+        return
+
+    # The Neo4j driver is synchronous, so fetch the schema off the event loop.
+    # A failed fetch keeps the agents on the old schema rather than failing the
+    # query, and the version is left unchanged so the next query retries it
+    try:
+        schema = await asyncio.to_thread(get_graph_schema)
+    except Exception as e:
+        log.warning("Graph schema refresh failed, keeping the old schema: %s", e)
+        return
+    _graph_schema_version = version
+    if schema != _graph_schema:
+        log.info("Graph schema changed, rebuilding the query agents")
+        _graph_schema = schema
+        _agent_cache.clear()
+
+
+def _get_query_agent(config: AblationConfig) -> Agent:
+    """Return the agent for the ablation configuration, creating it on first use."""
+    # Only these fields change the agent, the rest are applied by the tools
+    key = (config.enable_graphrag, config.enable_vector_search, config.enable_cypher_queries)
+    agent = _agent_cache.get(key)
+    if agent is None:
+        agent = _agent_cache[key] = _create_query_agent(config)
+    return agent
+
+
 def _create_query_agent(config: AblationConfig) -> Agent:
     """Create an agent with tools based on ablation configuration."""
     # Select the appropriate system prompt based on configuration
@@ -151,6 +231,7 @@ def _create_query_agent(config: AblationConfig) -> Agent:
         system_prompt = NEO4J_QUERY_SYSTEM_PROMPT_VECTOR_ONLY
     else:
         system_prompt = NEO4J_QUERY_SYSTEM_PROMPT_FULL
+    system_prompt = system_prompt.replace(GRAPH_SCHEMA_PLACEHOLDER, _graph_schema)
 
     # Create agent
     agent = Agent(
@@ -166,42 +247,197 @@ def _create_query_agent(config: AblationConfig) -> Agent:
             agent.tool(query_neo4j)
         if config.enable_vector_search:
             agent.tool(vector_search)
+        if config.enable_cypher_queries and config.enable_vector_search:
+            agent.tool(vector_graph_query)
 
     return agent
 
 
-async def query(question: str, ablation_config: Optional[AblationConfig] = None) -> GraphQueryResult:
+async def query(
+    question: str,
+    ablation_config: Optional[AblationConfig] = None,
+    use_semantic_cache: bool = True,
+) -> GraphQueryResult:
     """
     Query Neo4j using natural language (async).
 
     Args:
         question: Natural language question
         ablation_config: Optional configuration for ablation studies to control GraphRAG behavior
+        use_semantic_cache: Whether a cached answer to a similar question may be reused,
+            when QUERY_SEMANTIC_CACHE_ENABLE is set
 
     Returns:
         GraphQueryResult with answer and data
     """
-    # Store ablation config in a global for tools to access
-    global _current_ablation_config
-    _current_ablation_config = ablation_config or AblationConfig()
+    # Store ablation config in a context variable for tools to access, so
+    # concurrent queries each see their own
+    token = _current_ablation_config.set(ablation_config or AblationConfig())
+    try:
+        return await _run_query(question, ablation_config, use_semantic_cache)
+    finally:
+        _current_ablation_config.reset(token)
+
+
+async def _run_query(
+    question: str, ablation_config: Optional[AblationConfig], use_semantic_cache: bool
+) -> GraphQueryResult:
+    """Answer a question under the ablation config of the current context"""
+    config = _current_ablation_config.get()
 
     # Log ablation configuration
     if ablation_config:
-        log.info(f"Ablation Config: {ablation_config.model_dump()}")
+        log.info("Ablation Config: %s", ablation_config.model_dump())
+
+    # Answers depend on the ablation config, so only reuse those given under
+    # the same config
+    config_key = config.model_dump_json()
+    question_embedding, cached_answer = await _lookup_answer(
+        config_key, question, use_semantic_cache
+    )
+    if cached_answer is not None:
+        return cached_answer
 
-    # Create agent with appropriate tools based on config
-    agent = _create_query_agent(_current_ablation_config)
+    # Get agent with appropriate tools based on config
+    await _refresh_graph_schema()
+    agent = _get_query_agent(config)
 
     result = await agent.run(
         question,
-        model_settings=json.loads(get_envvar("QUERY_MODEL_SETTINGS")),
+        model_settings=QUERY_MODEL_SETTINGS,
         usage_limits=UsageLimits(request_limit=100)  # Increase limit from default 50 to 100
     )
+
+    _remember_answer(config_key, question_embedding, result.output)
     return result.output
 
 
-# Global to store current ablation config
-_current_ablation_config: AblationConfig = AblationConfig()
+async def query_stream(
+    question: str,
+    ablation_config: Optional[AblationConfig] = None,
+    use_semantic_cache: bool = True,
+) -> AsyncIterator[GraphQueryResult]:
+    """
+    Query Neo4j using natural language, yielding the answer as it is generated.
+
+    Args:
+        question: Natural language question
+        ablation_config: Optional configuration for ablation studies to control GraphRAG behavior
+        use_semantic_cache: Whether a cached answer to a similar question may be reused,
+            when QUERY_SEMANTIC_CACHE_ENABLE is set
+
+    Yields:
+        GraphQueryResult filled in as far as generated so far, the last one complete
+    """
+    token = _current_ablation_config.set(ablation_config or AblationConfig())
+    try:
+        config = _current_ablation_config.get()
+        if ablation_config:
+            log.info("Ablation Config: %s", ablation_config.model_dump())
+
+        config_key = config.model_dump_json()
+        question_embedding, cached_answer = await _lookup_answer(
+            config_key, question, use_semantic_cache
+        )
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
+        await _refresh_graph_schema()
+        agent = _get_query_agent(config)
+        async with agent.run_stream(
+            question,
+            model_settings=QUERY_MODEL_SETTINGS,
+            usage_limits=UsageLimits(request_limit=100)
+        ) as result:
+            async for output in result.stream_output():
+                yield output
+            output = await result.get_output()
+
+        _remember_answer(config_key, question_embedding, output)
+    finally:
+        _current_ablation_config.reset(token)
+
+
+async def batch_query(
+    questions: list[str],
+    ablation_config: Optional[AblationConfig] = None,
+    max_concurrency: int = QUERY_MAX_CONCURRENCY,
+    use_semantic_cache: bool = True,
+) -> list[GraphQueryResult]:
+    """
+    Query Neo4j with several natural language questions concurrently.
+
+    Args:
+        questions: Natural language questions
+        ablation_config: Optional configuration for ablation studies, applied to every question
+        max_concurrency: Largest number of questions answered at once
+        use_semantic_cache: False to answer every question afresh
+
+    Returns:
+        GraphQueryResult for each question, in the order of the questions
+    """
+    # Bound the number of agent runs in flight to stay within the API rate limits
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def _query_one(question: str) -> GraphQueryResult:
+        async with sem:
+            return await query(question, ablation_config, use_semantic_cache)
+
+    return await asyncio.gather(*[_query_one(question) for question in questions])
+
+
+async def _lookup_answer(
+    config_key: str, question: str, use_semantic_cache: bool
+) -> tuple[Optional[np.ndarray], Optional[GraphQueryResult]]:
+    """
+    Return the normalized question embedding and its cached answer, if any.
+    The embedding is None when the semantic cache is not used, so the answer
+    is not remembered either.
+    """
+    if not (SEMANTIC_CACHE_ENABLE and use_semantic_cache):
+        return None, None
+    question_embedding = await embed_content(question)
+    question_embedding = question_embedding / (
+        np.linalg.norm(question_embedding) or 1.0
+    )
+    return question_embedding, _get_cached_answer(config_key, question_embedding)
+
+
+def _remember_answer(
+    config_key: str, question_embedding: Optional[np.ndarray], answer: GraphQueryResult
+):
+    """Add the answer to the semantic answer cache, dropping the oldest beyond its size"""
+    if question_embedding is not None:
+        _answer_cache.append((config_key, question_embedding, answer, time.time()))
+        if len(_answer_cache) > SEMANTIC_CACHE_MAXSIZE:
+            _answer_cache.pop(0)
+
+
+def _get_cached_answer(
+    config_key: str, question_embedding: np.ndarray
+) -> Optional[GraphQueryResult]:
+    """Return the answer to the most similar cached question, if similar enough"""
+    current_time = time.time()
+    _answer_cache[:] = [
+        entry for entry in _answer_cache if (current_time - entry[3]) < CACHE_TTL
+    ]
+    candidates = [entry for entry in _answer_cache if entry[0] == config_key]
+    if not candidates:
+        return None
+
+    scores = np.stack([entry[1] for entry in candidates]) @ question_embedding
+    best = int(scores.argmax())
+    if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    log.debug("SEMANTIC CACHE HIT - similarity %.4f", scores[best])
+    return candidates[best][2]
+
+
+# Ablation config of the query running in the current context
+_current_ablation_config: ContextVar[AblationConfig] = ContextVar(
+    "_current_ablation_config", default=AblationConfig()
+)
 
 
 def query_neo4j(ctx: RunContext[None], cypher_query: str) -> list[dict[str, Any]]:
@@ -218,7 +454,8 @@ def query_neo4j(ctx: RunContext[None], cypher_query: str) -> list[dict[str, Any]
     modified_query = _apply_ablation_filters(cypher_query)
     if modified_query != cypher_query:
         log.info(
-            f"Query modified by ablation config:\nOriginal: {cypher_query}\nModified: {modified_query}")
+            "Query modified by ablation config:\nOriginal: %s\nModified: %s",
+            cypher_query, modified_query)
 
     # Clean expired cache entries periodically
     _clean_expired_cache()
@@ -226,33 +463,34 @@ def query_neo4j(ctx: RunContext[None], cypher_query: str) -> list[dict[str, Any]
     # Check cache first
     cache_func = None
     if CACHE_ENABLE:
-        cache_key = _get_cache_key(modified_query)
+        cache_key = modified_query
         if cache_key in _query_cache:
             cached_result, timestamp = _query_cache[cache_key]
             if _is_cache_valid(timestamp):
-                log.debug(f"\n{'=' * 60}")
+                _query_cache.move_to_end(cache_key)
+                log.debug("\n%s", DEBUG_SEPARATOR)
                 log.debug("CACHE HIT - Using cached result")
-                log.debug(f"{'=' * 60}")
-                log.debug(f"Query: {modified_query}")
-                log.debug(f"{'=' * 60}\n")
+                log.debug(DEBUG_SEPARATOR)
+                log.debug("Query: %s", modified_query)
+                log.debug("%s\n", DEBUG_SEPARATOR)
                 return cached_result
         cache_func = _query_cache_func
 
-    log.debug(f"{'=' * 60}")
+    log.debug(DEBUG_SEPARATOR)
     log.debug("GENERATED CYPHER QUERY:")
-    log.debug(f"{'=' * 60}")
+    log.debug(DEBUG_SEPARATOR)
     log.debug(modified_query)
-    log.debug(f"{'=' * 60}\n")
+    log.debug("%s\n", DEBUG_SEPARATOR)
 
     return process_query(modified_query, cache_func=cache_func)
 
 
 def _query_cache_func(cypher_query, records):
-    log.debug(f"{'=' * 60}")
+    log.debug(DEBUG_SEPARATOR)
     log.debug("QUERY CACHE MISS - Caching result")
-    log.debug(f"{'=' * 60}")
-    cache_key = _get_cache_key(cypher_query)
-    _query_cache[cache_key] = (records, time.time())
+    log.debug(DEBUG_SEPARATOR)
+    cache_key = cypher_query
+    _store_cache_entry(_query_cache, cache_key, records)
 
 
 async def vector_search(
@@ -267,67 +505,125 @@ async def vector_search(
         top_k: Number of top results to return (default 5)
 
     Returns:
-        List of matching nodes with their properties and similarity scores
+        List of matching nodes with their properties and similarity scores.
+        Long text properties are truncated, query the node for the full text.
     """
     # Apply max_vector_results override if specified
-    if _current_ablation_config.max_vector_results is not None:
-        top_k = min(top_k, _current_ablation_config.max_vector_results)
-        log.info(f"Vector search top_k limited to {top_k} by ablation config")
+    ablation_config = _current_ablation_config.get()
+    if ablation_config.max_vector_results is not None:
+        top_k = min(top_k, ablation_config.max_vector_results)
+        log.info("Vector search top_k limited to %d by ablation config", top_k)
 
     # Clean expired cache entries periodically
     _clean_expired_cache()
 
     # Check cache first
     cache_func = None
-    cache_query = f"{query_text}|{index_name}|{top_k}"
     if CACHE_ENABLE:
-        cache_key = _get_cache_key(cache_query)
+        # A tuple key cannot collide the way joining the parts with a
+        # separator could when the query text contains it
+        cache_key = (query_text, index_name, top_k)
         if cache_key in _vector_cache:
             cached_result, timestamp = _vector_cache[cache_key]
             if _is_cache_valid(timestamp):
-                log.debug(f"\n{'=' * 60}")
+                _vector_cache.move_to_end(cache_key)
+                log.debug("\n%s", DEBUG_SEPARATOR)
                 log.debug("CACHE HIT - Using cached vector search result")
-                log.debug(f"{'=' * 60}")
-                log.debug(f"Query: {query_text}")
-                log.debug(f"Index: {index_name}")
-                log.debug(f"Top K: {top_k}")
-                log.debug(f"{'=' * 60}\n")
+                log.debug(DEBUG_SEPARATOR)
+                log.debug("Query: %s", query_text)
+                log.debug("Index: %s", index_name)
+                log.debug("Top K: %s", top_k)
+                log.debug("%s\n", DEBUG_SEPARATOR)
                 # Apply node type filtering to cached results
-                return _filter_results_by_node_type(cached_result)
+                return _truncate_long_values(_filter_results_by_node_type(cached_result))
         cache_func = _vector_search_cache_func
 
-    log.debug(f"{'=' * 60}")
+    log.debug(DEBUG_SEPARATOR)
     log.debug("VECTOR SEARCH:")
-    log.debug(f"{'=' * 60}")
-    log.debug(f"Query: {query_text}")
-    log.debug(f"Index: {index_name}")
-    log.debug(f"Top K: {top_k}")
-    log.debug(f"{'=' * 60}\n")
+    log.debug(DEBUG_SEPARATOR)
+    log.debug("Query: %s", query_text)
+    log.debug("Index: %s", index_name)
+    log.debug("Top K: %s", top_k)
+    log.debug("%s\n", DEBUG_SEPARATOR)
 
     # Generate embedding for the query text
     query_embedding = await embed_content(query_text)
-    log.debug(f"Generated embedding (dim: {len(query_embedding)})")
+    log.debug("Generated embedding (dim: %d)", len(query_embedding))
 
-    # Execute the vector search query
-    results = process_vector_search(
+    # Execute the vector search query, in a thread since the Neo4j driver is
+    # synchronous and this tool runs on the event loop
+    results = await asyncio.to_thread(
+        process_vector_search,
         index_name, top_k, query_embedding, query_text, cache_func=cache_func
     )
 
     # Apply node type filtering
-    return _filter_results_by_node_type(results)
+    return _truncate_long_values(_filter_results_by_node_type(results))
+
+
+async def vector_graph_query(
+    ctx: RunContext[None],
+    query_text: str,
+    index_name: str,
+    cypher_query: str,
+    top_k: int = 5,
+) -> list[dict[str, Any]]:
+    """
+    Find nodes by vector similarity and traverse the graph from them, in a single step.
+
+    The cypher_query continues a query in which each matching node is bound to
+    `seed` and its similarity score to `score`, for example:
+    MATCH (seed)<-[:USES_DATASET]-(p:Paper) RETURN seed.title AS dataset, score, p.title AS paper
 
+    Args:
+        query_text: The text to search for semantically
+        index_name: Name of the vector index to search. Available indexes are shown in the schema.
+        cypher_query: Cypher continuing from the `seed` and `score` variables
+        top_k: Number of most similar nodes to traverse from (default 5)
+
+    Returns:
+        List of records as dictionaries, with returned nodes as their properties
+        minus the embedding
+    """
+    ablation_config = _current_ablation_config.get()
+    if ablation_config.max_vector_results is not None:
+        top_k = min(top_k, ablation_config.max_vector_results)
+    modified_query = _apply_ablation_filters(cypher_query)
+
+    log.debug(DEBUG_SEPARATOR)
+    log.debug("VECTOR GRAPH QUERY:")
+    log.debug(DEBUG_SEPARATOR)
+    log.debug("Query: %s", query_text)
+    log.debug("Index: %s", index_name)
+    log.debug("Top K: %s", top_k)
+    log.debug(modified_query)
+    log.debug("%s\n", DEBUG_SEPARATOR)
+
+    query_embedding = await embed_content(query_text)
+    return await asyncio.to_thread(
+        process_seeded_query,
+        index_name, top_k, query_embedding, modified_query,
+        sorted(ablation_config.excluded_node_types_set),
+    )
 
-def _vector_search_cache_func(cache_query, records):
-    log.debug(f"{'=' * 60}")
+
+def _vector_search_cache_func(cache_key, records):
+    log.debug(DEBUG_SEPARATOR)
     log.debug("VECTOR CACHE MISS - Caching result")
-    log.debug(f"{'=' * 60}")
-    cache_key = _get_cache_key(cache_query)
-    _vector_cache[cache_key] = (records, time.time())
+    log.debug(DEBUG_SEPARATOR)
+    _store_cache_entry(_vector_cache, cache_key, records)
 
 
-def _get_cache_key(query: str) -> str:
-    """Generate a cache key from a query string"""
-    return hashlib.md5(query.encode()).hexdigest()
+def _store_cache_entry(
+    cache: OrderedDict[Hashable, tuple[list[dict[str, Any]], float]],
+    cache_key: Hashable,
+    records: list[dict[str, Any]],
+):
+    """Store the records as the most recently used entry, evicting beyond CACHE_MAXSIZE"""
+    cache[cache_key] = (records, time.time())
+    cache.move_to_end(cache_key)
+    while len(cache) > CACHE_MAXSIZE:
+        cache.popitem(last=False)
 
 
 def _is_cache_valid(timestamp: float) -> bool:
@@ -338,30 +634,22 @@ def _is_cache_valid(timestamp: float) -> bool:
 def _clean_expired_cache():
     """Remove expired entries from both caches"""
     current_time = time.time()
-
-    # Clean query cache
-    expired_keys = [
-        key
-        for key, (_, timestamp) in _query_cache.items()
-        if (current_time - timestamp) >= CACHE_TTL
-    ]
-    for key in expired_keys:
-        del _query_cache[key]
-
-    # Clean vector cache
-    expired_keys = [
-        key
-        for key, (_, timestamp) in _vector_cache.items()
-        if (current_time - timestamp) >= CACHE_TTL
-    ]
-    for key in expired_keys:
-        del _vector_cache[key]
+    for cache in (_query_cache, _vector_cache):
+        # Sweep from the least recently used end and stop at the first
+        # entry that is still valid. Entries moved up by a hit can expire
+        # further in, those are caught by the TTL check on read or evicted
+        while cache:
+            _, timestamp = next(iter(cache.values()))
+            if (current_time - timestamp) < CACHE_TTL:
+                break
+            cache.popitem(last=False)
 
 
 def clear_cache():
     """Manually clear all caches"""
     _query_cache.clear()
     _vector_cache.clear()
+    _answer_cache.clear()
     log.debug("Cache cleared")
 
 
@@ -379,42 +667,73 @@ def _apply_ablation_filters(cypher_query: str) -> str:
         Modified Cypher query with ablation filters applied
     """
     modified_query = cypher_query
-
-    # Add WHERE clauses to exclude certain node types
-    if _current_ablation_config.excluded_node_types:
-        for node_type in _current_ablation_config.excluded_node_types:
-            # Simple approach: add a global WHERE clause
-            if "WHERE" in modified_query:
-                # Find all variable names used in MATCH clauses
-                variables = re.findall(r'MATCH\s+\((\w+)', modified_query)
-                for var in set(variables):
-                    where_clause = f" AND NOT {var}:{node_type}"
-                    if where_clause not in modified_query:
-                        modified_query = modified_query.replace(
-                            " RETURN", f"{where_clause} RETURN", 1)
-            else:
-                # Add new WHERE clause before RETURN
-                variables = re.findall(r'MATCH\s+\((\w+)', modified_query)
-                if variables:
-                    where_conditions = [
-                        f"NOT {var}:{node_type}" for var in set(variables)]
-                    where_clause = f" WHERE {' AND '.join(where_conditions)}"
-                    modified_query = modified_query.replace(
-                        " RETURN", f"{where_clause} RETURN", 1)
+    ablation_config = _current_ablation_config.get()
+
+    # Add WHERE clauses to exclude certain node types, for every variable
+    # bound by a MATCH clause, with a single rewrite of the query
+    if ablation_config.excluded_node_types:
+        variables = set(MATCH_VARIABLE_RE.findall(modified_query))
+        conditions = list(dict.fromkeys(
+            f"NOT {var}:{node_type}"
+            for node_type in ablation_config.excluded_node_types
+            for var in variables
+        ))
+        if "WHERE" in modified_query:
+            where_clause = "".join(
+                f" AND {condition}"
+                for condition in conditions
+                if f" AND {condition}" not in modified_query
+            )
+        elif conditions:
+            where_clause = f" WHERE {' AND '.join(conditions)}"
+        else:
+            where_clause = ""
+        if where_clause:
+            modified_query = modified_query.replace(
+                " RETURN", f"{where_clause} RETURN", 1)
 
     # Filter out excluded relationships
-    if _current_ablation_config.excluded_relationships:
-        for rel_type in _current_ablation_config.excluded_relationships:
-            pattern = f'\\[\\w*:{rel_type}\\]'
-            if re.search(pattern, modified_query):
+    if ablation_config.excluded_relationships:
+        # One scan of the query finds every excluded type it uses
+        pattern = _relationships_pattern(tuple(ablation_config.excluded_relationships))
+        found = set(pattern.findall(modified_query))
+        for rel_type in ablation_config.excluded_relationships:
+            if rel_type in found:
                 log.warning(
-                    f"Query contains excluded relationship type {rel_type}, returning empty result")
+                    "Query contains excluded relationship type %s, returning empty result",
+                    rel_type)
                 # Rather than trying to remove it, just flag it
                 # You might want to return an empty result or modify the query differently
 
     return modified_query
 
 
+@lru_cache(maxsize=64)
+def _relationships_pattern(rel_types: tuple[str, ...]) -> re.Pattern:
+    """Compiled pattern matching a relationship of any of the given types in a query"""
+    alternatives = "|".join(map(re.escape, rel_types))
+    return re.compile(f'\\[\\w*:({alternatives})\\]')
+
+
+def _truncate_long_values(results: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Shorten the long text properties of vector search results, which would
+    otherwise fill the agent's context. The cached results are left whole.
+    """
+    if VECTOR_RESULT_MAX_CHARS <= 0:
+        return results
+
+    def _truncate(value: Any) -> Any:
+        if isinstance(value, str) and len(value) > VECTOR_RESULT_MAX_CHARS:
+            return value[:VECTOR_RESULT_MAX_CHARS] + "..."
+        return value
+
+    return [
+        {**result, "node": {k: _truncate(v) for k, v in result.get("node", {}).items()}}
+        for result in results
+    ]
+
+
 def _filter_results_by_node_type(results: list[dict[str, Any]]) -> list[dict[str, Any]]:
     """
     Filter vector search results based on excluded node types.
@@ -425,27 +744,21 @@ def _filter_results_by_node_type(results: list[dict[str, Any]]) -> list[dict[str
     Returns:
         Filtered list with excluded node types removed
     """
-    if not _current_ablation_config.excluded_node_types:
+    ablation_config = _current_ablation_config.get()
+    if not ablation_config.excluded_node_types:
         return results
 
+    excluded = ablation_config.excluded_node_types_set
     filtered = []
     for result in results:
-        # Check if the node has labels
-        node = result.get('node', {})
-        labels = node.get('labels', [])
-
-        # If node is actually in the result dict itself (different structure)
-        if not labels and 'labels' in result:
-            labels = result['labels']
-
-        # Check if any of the node's labels are in the excluded list
-        is_excluded = any(
-            label in _current_ablation_config.excluded_node_types for label in labels)
+        # Labels are on the node, or on the result dict itself when the
+        # node is returned flattened
+        labels = result.get('node', {}).get('labels') or result.get('labels', ())
 
-        if not is_excluded:
+        if excluded.isdisjoint(labels):
             filtered.append(result)
         else:
             log.debug(
-                f"Filtered out node with labels {labels} due to ablation config")
+                "Filtered out node with labels %s due to ablation config", labels)
 
     return filtered
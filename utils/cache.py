@@ -0,0 +1,84 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+import orjson
+
+from utils.utils import get_envvar
+
+CACHE_DIR = get_envvar("CACHE_DIR", "./cache/")
+EMBEDDING_CACHE_DB = os.path.join(CACHE_DIR, "embeddings.sqlite3")
+
+# Stay well below SQLite's limit on the number of bound query parameters
+_SQLITE_BATCH_SIZE = 500
+
+
+def content_hash(content: bytes | str) -> str:
+    """Returns the SHA-256 hex digest of the given content."""
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.sha256(content).hexdigest()
+
+
+def _cache_path(namespace: str, key: str) -> str:
+    return os.path.join(CACHE_DIR, namespace, f"{key}.txt")
+
+
+def read_cache(namespace: str, key: str) -> str | None:
+    """Returns the cached text stored under the key, or None on a miss."""
+    try:
+        with open(_cache_path(namespace, key), encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_cache(namespace: str, key: str, value: str):
+    """Stores the text under the key, replacing any existing entry."""
+    path = _cache_path(namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so readers never see a partial entry.
+    # Callers write from worker threads, so the name is unique per thread
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(value)
+    os.replace(tmp_path, path)
+
+
+def _connect_embedding_cache() -> sqlite3.Connection:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(EMBEDDING_CACHE_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding TEXT)"
+    )
+    return conn
+
+
+def read_embeddings(keys: list[str]) -> dict[str, list[float]]:
+    """Returns the cached embeddings for the keys that are present."""
+    found = {}
+    with closing(_connect_embedding_cache()) as conn:
+        for i in range(0, len(keys), _SQLITE_BATCH_SIZE):
+            batch = keys[i : i + _SQLITE_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                batch,
+            )
+            found.update((key, orjson.loads(embedding)) for key, embedding in rows)
+    return found
+
+
+def write_embeddings(entries: dict[str, np.ndarray]):
+    """Stores the embeddings, replacing any existing entries with the same key."""
+    with closing(_connect_embedding_cache()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            [
+                (key, orjson.dumps(embedding, option=orjson.OPT_SERIALIZE_NUMPY))
+                for key, embedding in entries.items()
+            ],
+        )
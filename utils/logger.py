@@ -1,6 +1,12 @@
+import atexit
+import copy
+import gzip
 import logging
 import logging.handlers
 import os
+import queue
+import shutil
+import sys
 
 from rich.logging import RichHandler
 
@@ -9,8 +15,7 @@ from utils.utils import get_envvar
 LOG_DATE_FMT = "[%d-%m-%Y %H:%M:%S]"
 
 log_dir = get_envvar("LOG_DIR")
-if not os.path.exists(log_dir):
-    os.mkdir(log_dir)
+os.makedirs(log_dir, exist_ok=True)
 
 log = logging.getLogger(get_envvar("LOG_NAME"))
 log.propagate = False
@@ -22,10 +27,24 @@ msg_formatter = logging.Formatter(
 rich_msg_formatter = logging.Formatter(fmt="%(message)s", datefmt=LOG_DATE_FMT)
 
 
+def gzip_namer(name):
+    return f"{name}.gz"
+
+
+def gzip_rotator(source, dest):
+    # Runs on the QueueListener thread, so compressing never blocks a request
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
 def create_time_rotating_file_handler(log_level, filename, formatter):
     handler = logging.handlers.TimedRotatingFileHandler(
         f"{log_dir}/{filename}.log", when="midnight", backupCount=30
     )
+    # Rotated logs are kept gzipped
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
     handler.setLevel(log_level)
     handler.setFormatter(formatter)
     return handler
@@ -48,11 +67,40 @@ error_handler = create_time_rotating_file_handler(
 # info_handler
 info_handler = create_time_rotating_file_handler(logging.INFO, "info", msg_formatter)
 
-info_stdout_handler = RichHandler(rich_tracebacks=True)
+# Rich formatting only pays off for a person watching a terminal, so plain
+# lines are written when stdout is redirected or LOG_PRETTY is off
+if sys.stdout.isatty() and get_envvar("LOG_PRETTY", "1") == "1":
+    info_stdout_handler = RichHandler(rich_tracebacks=True)
+    info_stdout_handler.setFormatter(rich_msg_formatter)
+else:
+    info_stdout_handler = logging.StreamHandler(sys.stdout)
+    info_stdout_handler.setFormatter(msg_formatter)
 info_stdout_handler.setLevel(logging.INFO)
-info_stdout_handler.setFormatter(rich_msg_formatter)
 
-log.addHandler(debug_handler)
-log.addHandler(error_handler)
-log.addHandler(info_handler)
-log.addHandler(info_stdout_handler)
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock prepare() formats the traceback into the message and drops
+        # exc_info, which would leave RichHandler without a traceback. Records
+        # never leave the process, so only the arguments need merging in
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# Records are handed to a background thread so the request path only
+# enqueues them, instead of formatting and writing under the handler locks
+log_queue = queue.SimpleQueue()
+log.addHandler(LocalQueueHandler(log_queue))
+
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    debug_handler,
+    error_handler,
+    info_handler,
+    info_stdout_handler,
+    respect_handler_level=True,
+)
+log_listener.start()
+atexit.register(log_listener.stop)
@@ -2,10 +2,17 @@ import os
 
 from dotenv import load_dotenv
 
+# Read the .env file once, rather than on every lookup
+load_dotenv()
 
-def get_envvar(var_name: str) -> str:
-    load_dotenv()
-    value = os.getenv(var_name)
+
+def get_envvar(var_name: str, default: str | None = None) -> str:
+    value = os.getenv(var_name, default)
     if value is None:
         raise ValueError(f"Environment variable {var_name} is not set.")
     return value
+
+
+def get_envflag(var_name: str, default: str | None = None) -> bool:
+    """Reads a boolean environment variable, true for 1/true/yes/on in any case."""
+    return get_envvar(var_name, default).strip().lower() in ("1", "true", "yes", "on")